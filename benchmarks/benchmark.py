@@ -0,0 +1,252 @@
+#!/usr/bin/python
+"""
+Benchmarks for musdex
+
+Generates a synthetic repository of zip archives in a temporary
+directory, with a stub VCS (fakevcs.py) plugged in through the vcs_*
+configuration keys, and times musdex (as separate processes, as it is
+used) for:
+
+    add         first-time add of every archive
+    extract     cold extract, without an index
+    noop        warm extract, with nothing to do
+    combine     combine after editing a single member
+    status      musdex status, the quickest command, as run from VCS hooks
+
+It also checks that musdex status doesn't import the modules only other
+commands need (STARTUP_EXCLUDED), as startup time dominates hook usage.
+
+Results are written as JSON, to compare runs over time:
+
+    python benchmarks/benchmark.py --archives 20 --members 200 -o run.json
+
+With --check (and optionally --max-startup) the exit status is non-zero
+if startup has regressed.
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import argparse
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKEVCS = os.path.join(ROOT, 'benchmarks', 'fakevcs.py')
+BASEDIR = '_musdex'
+CONFIG = os.path.join(BASEDIR, 'musdex.yaml')
+
+# Modules that musdex status should not need to import (other than
+# sqlite3, for the sqlite index format); also checked by
+# tests/test_startup.py
+STARTUP_EXCLUDED = ['concurrent.futures.process', 'ctypes', 'multiprocessing',
+                    'sqlite3', 'subprocess', 'zipfile', 'musdex.formatters',
+                    'musdex.handlers', 'musdex.watch']
+
+IMPORTED_MODULES = """
+import runpy, sys
+sys.argv = ['musdex', '-q', 'status']
+try:
+    runpy.run_module('musdex', run_name='__main__', alter_sys=True)
+except SystemExit:
+    pass
+sys.stdout.write('\\n'.join(sorted(sys.modules)))
+"""
+
+WORDS = [b'musdex', b'archive', b'document', b'paragraph', b'<w:t>',
+         b'</w:t>', b'version', b'control', b'\n']
+
+def member_data(rng, size, compressibility):
+    """
+    Generate member content of which roughly the given fraction is
+    compressible text and the rest random bytes
+    """
+    text = int(size * compressibility)
+    data = bytearray()
+    while len(data) < text:
+        data += rng.choice(WORDS)
+    del data[text:]
+    noise = size - text
+    if noise > 0:
+        data += rng.getrandbits(noise * 8).to_bytes(noise, 'little')
+    return bytes(data)
+
+def generate(directory, args):
+    """
+    Generate the archives and configuration of a synthetic repository
+    """
+    rng = random.Random(args.seed)
+    archives = []
+    for i in range(args.archives):
+        name = 'archive%03d.zip' % i
+        with zipfile.ZipFile(os.path.join(directory, name), 'w',
+                             zipfile.ZIP_DEFLATED) as archive:
+            for j in range(args.members):
+                archive.writestr('part%d/member%04d.xml' % (j % 10, j),
+                                 member_data(rng, args.member_size,
+                                             args.compressibility))
+        archives.append(name)
+
+    vcs = '%s %s' % (sys.executable, FAKEVCS)
+    os.makedirs(os.path.join(directory, BASEDIR))
+    with open(os.path.join(directory, CONFIG), 'w') as config:
+        config.write('vcs_show_files: %s ls\n' % vcs)
+        config.write('vcs_add: %s add\n' % vcs)
+        config.write('vcs_remove: %s rm\n' % vcs)
+        if args.index_format:
+            config.write('index_format: %s\n' % args.index_format)
+    return archives
+
+def _environ():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in
+        env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    return env
+
+def musdex(directory, *command):
+    """
+    Run musdex in a new process, returning the wall time it took
+    """
+    env = _environ()
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-m', 'musdex', '-q']
+                          + list(command), cwd=directory, env=env)
+    return time.perf_counter() - start
+
+def startup_imports(directory, index_format):
+    """
+    List the STARTUP_EXCLUDED modules that musdex status imports
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORTED_MODULES],
+                                     cwd=directory, env=_environ(),
+                                     universal_newlines=True)
+    modules = set(output.split())
+    return [module for module in STARTUP_EXCLUDED if module in modules
+            and not (module == 'sqlite3' and index_format == 'sqlite')]
+
+def reset_extraction(directory):
+    """
+    Remove extracted files and the index, leaving the configuration (and
+    VCS manifest) in place
+    """
+    for name in os.listdir(os.path.join(directory, BASEDIR)):
+        path = os.path.join(directory, BASEDIR, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif name != 'musdex.yaml':
+            os.remove(path)
+
+def edit_member(directory, archives, run):
+    path = os.path.join(directory, BASEDIR, archives[0], 'part0',
+                        'member0000.xml')
+    with open(path, 'ab') as member:
+        member.write(b'<!-- edit %d -->\n' % run)
+
+def summary(times):
+    times = sorted(times)
+    return {
+        'runs': times,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+    }
+
+def run(args):
+    results = dict((name, []) for name in ('add', 'extract', 'noop',
+                                           'combine', 'status'))
+    imports = None
+    for i in range(args.repeat):
+        directory = tempfile.mkdtemp(prefix='musdex-bench-')
+        try:
+            archives = generate(directory, args)
+            jobs = ['--jobs', str(args.jobs)] if args.jobs else []
+
+            results['add'].append(musdex(directory, 'add', *archives))
+            reset_extraction(directory)
+            results['extract'].append(musdex(directory, 'extract', *jobs))
+            results['noop'].append(musdex(directory, 'extract', *jobs))
+            time.sleep(0.01) # Make sure the edit has a newer timestamp
+            edit_member(directory, archives, i)
+            results['combine'].append(musdex(directory, 'combine', *jobs))
+            results['status'].append(musdex(directory, 'status'))
+            if imports is None:
+                imports = startup_imports(directory, args.index_format)
+        finally:
+            if args.keep:
+                sys.stderr.write("Kept %s\n" % directory)
+            else:
+                shutil.rmtree(directory)
+    return results, imports
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark musdex")
+    parser.add_argument('--archives', type=int, default=10)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--member-size', type=int, default=16 * 1024)
+    parser.add_argument('--compressibility', type=float, default=0.9,
+                        help="fraction of each member that is text")
+    parser.add_argument('--index-format', choices=['yaml', 'sqlite'])
+    parser.add_argument('--jobs', '-j', type=int)
+    parser.add_argument('--repeat', '-r', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help="keep the generated repositories")
+    parser.add_argument('--output', '-o', help="JSON file (default stdout)")
+    parser.add_argument('--check', action='store_true', default=False,
+                        help="fail if musdex status imports modules it "
+                        "shouldn't need")
+    parser.add_argument('--max-startup', type=float, metavar='SECONDS',
+                        help="with --check, also fail if the median musdex "
+                        "status time is longer")
+    args = parser.parse_args()
+
+    results, imports = run(args)
+    report = {
+        'parameters': dict((key, value) for key, value in vars(args).items()
+                           if key not in ('keep', 'output', 'check',
+                                          'max_startup')),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': dict((name, summary(times))
+                        for name, times in results.items()),
+        'startup_imports': imports,
+    }
+    try:
+        report['revision'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.check:
+        failed = False
+        if imports:
+            sys.stderr.write("musdex status imports %s\n" % ', '.join(imports))
+            failed = True
+        startup = report['results']['status']['median']
+        if args.max_startup is not None and startup > args.max_startup:
+            sys.stderr.write("musdex status took %.3fs (limit %.3fs)\n"
+                             % (startup, args.max_startup))
+            failed = True
+        if failed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+"""
+Stub VCS for the musdex benchmarks
+
+Tracks files in a plain list (.fakevcs) in the current directory and
+answers the vcs_show_files, vcs_add and vcs_remove commands:
+
+    fakevcs.py ls
+    fakevcs.py add FILE...
+    fakevcs.py rm FILE...
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import os.path
+import sys
+
+DB = '.fakevcs'
+
+def main(argv):
+    files = []
+    if os.path.exists(DB):
+        with open(DB, 'r') as db:
+            files = [f for f in db.read().split('\n') if f]
+    cmd, args = argv[0], argv[1:]
+    if cmd == 'ls':
+        sys.stdout.write(''.join(f + '\n' for f in files))
+        return
+    elif cmd == 'add':
+        tracked = set(files)
+        files.extend(f for f in args if f not in tracked)
+    elif cmd == 'rm':
+        removed = set(args)
+        files = [f for f in files if f not in removed]
+    else:
+        sys.exit("Unknown command: %s" % cmd)
+    with open(DB, 'w') as db:
+        db.write('\n'.join(files))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -27,9 +27,9 @@ def main(booznik=False):
     except ImportError:
         from musdex.config import load_config
     try:
-        from . import commands
+        from . import commands, timings
     except ImportError:
-        from musdex import commands
+        from musdex import commands, timings
     import argparse
     import logging
     import sys
@@ -38,17 +38,27 @@ def main(booznik=False):
     parser.add_argument('--config', '-c')
     parser.add_argument('--verbose', '-v', action="store_true", default=False)
     parser.add_argument('--quiet', '-q', action="store_true", default=False)
+    parser.add_argument('--timings', metavar='FILE')
+    parser.add_argument('--profile', metavar='FILE')
     subparsers = parser.add_subparsers()
 
     parser_extract = subparsers.add_parser('extract')
     parser_extract.add_argument('--force', '-f', action="store_true",
                                 default=False)
+    parser_extract.add_argument('--jobs', '-j', type=int, default=None)
+    parser_extract.add_argument('--changed', action="store_true",
+                                default=False)
+    parser_extract.add_argument('--changed-from', metavar='FILE')
     parser_extract.add_argument('archive', nargs='*')
     parser_extract.set_defaults(func=commands.extract)
 
     parser_combine = subparsers.add_parser('combine')
     parser_combine.add_argument('--force', '-f', action="store_true",
                                 default=False)
+    parser_combine.add_argument('--jobs', '-j', type=int, default=None)
+    parser_combine.add_argument('--changed', action="store_true",
+                                default=False)
+    parser_combine.add_argument('--changed-from', metavar='FILE')
     parser_combine.add_argument('archive', nargs='*')
     parser_combine.set_defaults(func=commands.combine)
 
@@ -63,6 +73,34 @@ def main(booznik=False):
     parser_remove.add_argument('archive', nargs='+')
     parser_remove.set_defaults(func=commands.remove)
 
+    parser_status = subparsers.add_parser('status')
+    parser_status.add_argument('--json', action="store_true", default=False)
+    parser_status.add_argument('archive', nargs='*')
+    parser_status.set_defaults(func=commands.status)
+
+    parser_ls = subparsers.add_parser('ls')
+    parser_ls.add_argument('--json', action="store_true", default=False)
+    parser_ls.add_argument('archive', nargs='*')
+    parser_ls.set_defaults(func=commands.ls)
+
+    parser_cat = subparsers.add_parser('cat')
+    parser_cat.add_argument('archive')
+    parser_cat.add_argument('member', nargs='+')
+    parser_cat.set_defaults(func=commands.cat)
+
+    parser_verify = subparsers.add_parser('verify')
+    parser_verify.add_argument('--jobs', '-j', type=int, default=None)
+    parser_verify.add_argument('--json', action="store_true", default=False)
+    parser_verify.add_argument('archive', nargs='*')
+    parser_verify.set_defaults(func=commands.verify)
+
+    parser_watch = subparsers.add_parser('watch')
+    parser_watch.add_argument('--poll', action="store_true", default=False)
+    parser_watch.add_argument('--interval', type=float, default=1.0)
+    parser_watch.add_argument('--debounce', type=float, default=0.5)
+    parser_watch.add_argument('archive', nargs='*')
+    parser_watch.set_defaults(func=commands.watch)
+
     args = sys.argv[1:]
     if not any(args):
         args = ['extract'] if not booznik else ['combine']
@@ -71,8 +109,36 @@ def main(booznik=False):
         logging.basicConfig(level=logging.DEBUG)
     elif not args.quiet:
         logging.basicConfig(level=logging.INFO)
-    config = load_config(args)
-    args.func(args, config)
+
+    recorder = None
+    if args.timings:
+        recorder = timings.Timings()
+        timings.enable(recorder)
+    profiler = None
+    if args.profile:
+        # Only this process (and thread) is profiled, so the work is kept
+        # in it rather than spread over jobs
+        if hasattr(args, 'jobs'):
+            if args.jobs is not None and args.jobs > 1:
+                logging.warning("Ignoring --jobs %d while profiling",
+                                args.jobs)
+            args.jobs = 1
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    command = args.func.__name__
+    try:
+        with timings.phase('config.load'):
+            config = load_config(args)
+        with timings.phase(command):
+            result = args.func(args, config)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if recorder is not None:
+            timings.write_report(recorder, args.timings, command)
+    sys.exit(result)
 
 def xedsum():
     """
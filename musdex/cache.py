@@ -0,0 +1,91 @@
+"""
+Local content-addressed cache of formatter output for musdex
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import hashlib
+import logging
+import os
+import os.path
+import tempfile
+
+class FormatterCache(object):
+    """
+    A directory of formatted outputs, keyed by formatter name and a hash of
+    the raw (unformatted) content
+
+    Entries are touched when they are used, so that pruning the cache down
+    to its size limit evicts the least recently used entries first.
+    """
+
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+
+    def key(self, name, data):
+        digest = hashlib.sha256(name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key):
+        """
+        Get the cached output for a key, or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        Store the output for a key
+        """
+        path = self._path(key)
+        entrydir = os.path.dirname(path)
+        try:
+            os.makedirs(entrydir, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=entrydir, suffix='.tmp~')
+            with os.fdopen(fd, 'wb') as entry:
+                entry.write(data)
+            os.replace(tmpname, path)
+        except OSError as err:
+            # The cache is only an optimization
+            logging.debug("Unable to cache formatter output: %s", err)
+
+    def prune(self):
+        """
+        Evict the least recently used entries over the size limit
+        """
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+        if total <= self.limit:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.limit:
+                break
+            logging.debug("Evicting cached formatter output: %s", path)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -3,27 +3,88 @@ musdex commands
 """
 # Copyright 2010 Max Battcher. Some rights reserved.
 # Licensed for use under the Ms-RL. See attached LICENSE file.
-import datetime
+from stat import S_ISDIR
+import argparse
 import logging
 import os
 import os.path
 import re
 import shutil
-import time
+import sys
 
-from .config import BASEDIR, load_index, save_index, save_config
-from .formatters import get_formatter
-from .handlers import get_handler
-from . import vcs
+from .config import BASEDIR, DEFAULT_CONFIG, load_config, \
+    load_formatter_cache, load_index, save_index, save_config
+from .index import IndexEntry, SqliteIndex, member_size_crc, to_entry
+from .scan import TreeScan, file_stat
+from . import timings, vcs
+
+# The handlers, formatters, process and thread pools and file system
+# watcher are only imported by the commands that use them: musdex often
+# runs from VCS hooks, where its startup time dominates
 
 def _mtime(filename):
-    return datetime.datetime(*time.localtime(os.path.getmtime(filename))[:6])
+    return os.stat(filename).st_mtime_ns
+
+def _entries(files):
+    """
+    Normalize handler results to (filename, IndexEntry) pairs, where an
+    entry of None means the file was removed
+    """
+    for item in files:
+        yield item[0], to_entry(item[1:]) if item[1] is not None else None
+
+def _file_changed(filename, entry, stat, touched):
+    """
+    Check if a file (with the given FileStat) has changed from its index
+    entry
+
+    The modification time is only a cheap first filter: the content of a
+    newer file is compared by size and CRC32 when the index knows them.
+    Files touched without changing are recorded with an updated entry.
+    """
+    if entry is None or stat is None:
+        return True
+    if stat.mtime <= entry.timestamp:
+        return False
+    if entry.crc is None or stat.size != entry.size:
+        return True
+    from .handlers import file_crc32
+    if file_crc32(filename) != entry.crc:
+        return True
+    touched[filename] = entry._replace(timestamp=stat.mtime)
+    return False
+
+def _tree_changed(scan, arcman, touched):
+    """
+    Check if any of an archive's manifest files has changed, walking its
+    directory with the given TreeScan only until a changed file is found
+    """
+    seen = set()
+    for filename, stat in scan:
+        if filename in arcman:
+            seen.add(filename)
+            if _file_changed(filename, arcman[filename], stat, touched):
+                return True
+    for filename in arcman:
+        if filename in seen:
+            continue
+        stat = scan.get(filename)
+        if stat is not None and S_ISDIR(stat.mode):
+            # Directory entries (which the scan doesn't list) have no
+            # content, and their timestamps change with their files
+            continue
+        if _file_changed(filename, arcman[filename], stat, touched):
+            return True
+    return False
 
 def add(args, config):
     """
     Add a file for tracking by musdex
     """
+    from .handlers import get_handler
     index = load_index(config)
+    batch = vcs.Batch(config)
+    fmts, cache = _post_extract(config)
 
     for archive in args.archive:
         archive = os.path.relpath(archive)
@@ -38,9 +99,9 @@ def add(args, config):
         if args.new:
             if not os.path.exists(arcloc):
                 os.makedirs(arcloc)
-                vcs.add_file(config, arcloc)
-            for filename, timestamp in arch.combine(force=True):
-                index[filename] = timestamp
+                batch.add_file(arcloc)
+            for filename, entry in _entries(arch.combine(force=True)):
+                index[filename] = entry
         else:
             if not arch.check():
                 logging.error("Archive not supported by given handler: %s: %s",
@@ -48,11 +109,13 @@ def add(args, config):
                 continue
 
             logging.info("Extracting archive for the first time: %s", archive)
-            files = arch.extract(force=True)
-            for filename, timestamp in files:
-                index[filename] = timestamp
+            # As by musdex extract, post-extract formatters included
+            files = _extract_archive(archive, arcloc, args.handler, {}, {},
+                                     True, fmts)
+            for filename, entry in files:
+                index[filename] = entry
                 if filename != arcloc:
-                    vcs.add_file(config, filename)
+                    batch.add_file(filename)
 
         entry = {'filename': archive}
         if args.handler:
@@ -61,8 +124,11 @@ def add(args, config):
             config['archives'] = []
         config['archives'].append(entry)
 
+    batch.flush()
     save_config(args, config)
     save_index(config, index)
+    if cache is not None:
+        cache.prune()
 
 def remove(args, config):
     """
@@ -75,6 +141,7 @@ def remove(args, config):
         return
 
     manifest = vcs.manifest(config)
+    batch = vcs.Batch(config, manifest)
 
     for archive in args.archive:
         archive = os.path.relpath(archive)
@@ -85,37 +152,271 @@ def remove(args, config):
             continue
 
         logging.info("Removing archive files from VCS.")
-        for filename in manifest:
-            if filename.startswith(arcloc):
-                vcs.remove_file(config, filename)
+        for filename in manifest.under(arcloc + os.sep):
+            batch.remove_file(filename)
 
-                if filename in index:
-                    del index[filename]
+            if filename in index:
+                del index[filename]
 
         config['archives'] = [arc for arc in config['archives'] \
             if arc['filename'] != archive]
 
+    batch.flush()
     save_config(args, config)
     save_index(config, index)
 
-def extract(args, config):
+def _handler_options(archive):
     """
-    Extract musdex tracked archive files
+    Any other keys of an archive's configuration are handler options
     """
-    index = load_index(config)
-    index_updated = False
+    return dict((key, value) for key, value in archive.items() \
+        if key not in ('filename', 'handler'))
 
-    fmts = []
-    if 'post_extract' in config:
-        logging.debug("Compiling post-extraction regular expressions")
-        fmts = [(re.compile(regex), get_formatter(fname)) \
-            for regex, fname in config['post_extract']]
+def _jobs(args):
+    jobs = getattr(args, 'jobs', None)
+    return jobs if jobs else (os.cpu_count() or 1)
+
+def _with_threads(tasks, jobs):
+    """
+    Add the number of threads each archive task should use to its
+    arguments: when the tasks run in parallel processes, the CPUs are
+    shared between them rather than each using a thread per CPU (and
+    otherwise None, for the default)
+    """
+    threads = None
+    workers = min(jobs, len(tasks))
+    if workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    return [(key, tuple(fargs) + (threads,)) for key, fargs in tasks]
+
+def _run_tasks(func, tasks, jobs):
+    """
+    Run func over the given (key, arguments) tasks, possibly in a process
+    pool, yielding (key, result, error) in task order
+    """
+    if jobs > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        logging.debug("Running %d tasks with %d jobs", len(tasks), jobs)
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+            futures = [(key, pool.submit(func, *fargs))
+                       for key, fargs in tasks]
+            for key, future in futures:
+                try:
+                    yield key, future.result(), None
+                except Exception as err:
+                    yield key, None, err
+    else:
+        for key, fargs in tasks:
+            try:
+                yield key, func(*fargs), None
+            except Exception as err:
+                yield key, None, err
+
+def _run_jobs(func, tasks, jobs, phase):
+    """
+    Run the per-archive tasks (whose first argument is the archive) as
+    with _run_tasks
 
+    When timings are being recorded, each task is timed as the given phase
+    where it runs, and its timings are merged in under its archive.
+    """
+    recorder = timings.current()
+    if recorder is None:
+        for task in _run_tasks(func, tasks, jobs):
+            yield task
+        return
+    tasks = [(key, (phase, func) + tuple(fargs)) for key, fargs in tasks]
+    for (_, fargs), (key, result, err) \
+    in zip(tasks, _run_tasks(timings.collect, tasks, jobs)):
+        if err is None:
+            result, report = result
+            recorder.merge(report, fargs[2])
+        yield key, result, err
+
+def _report_failures(action, failures):
+    for arcf, err in failures:
+        logging.error("Unable to %s %s: %s", action, arcf, err)
+        logging.debug("Failure details for %s", arcf, exc_info=err)
+    if failures:
+        logging.error("%d archive(s) failed to %s", len(failures), action)
+        return 1
+
+def _read_changed(filename):
+    if filename == '-':
+        data = sys.stdin.read()
+    else:
+        with open(filename, 'r') as f:
+            data = f.read()
+    # NUL separated (as from git's -z options) or one path per line
+    return [path for path in data.split('\0' if '\0' in data else '\n')
+            if path.strip()]
+
+def _path_archive(path, archives):
+    """
+    Find the archive (of the given archive filenames) a path belongs to,
+    as (archive, whether the path is the archive file itself), or None
+    """
+    path = os.path.relpath(path)
+    if path in archives:
+        return path, True
+    if not path.startswith(BASEDIR + os.sep):
+        return None
+    path = os.path.relpath(path, BASEDIR)
+    while path and path not in archives:
+        path = os.path.dirname(path)
+    return (path, False) if path else None
+
+def _hook_mode(args):
+    return getattr(args, 'changed', False) \
+        or getattr(args, 'changed_from', None)
+
+def _changed_archives(args, config):
+    """
+    Map the changed paths given to a command (from a file, stdin or the
+    VCS) to the configured archives they affect: an archive file itself
+    or any file under its location
+    """
+    if args.changed_from:
+        changed = _read_changed(args.changed_from)
+    else:
+        changed = vcs.changed_files(config)
+    archives = set(archive['filename'] for archive in config['archives'])
+    affected = set()
+    for path in changed:
+        found = _path_archive(path.strip(), archives)
+        if found is not None:
+            affected.add(found[0])
+    logging.debug("%d changed path(s) affect %d archive(s)", len(changed),
+                  len(affected))
     if args.archive:
-        args.archive = map(os.path.relpath, args.archive)
+        affected &= set(args.archive)
+    return sorted(affected)
 
-    manifest = vcs.manifest(config)
+def _extract_archive(arcf, arcloc, hname, options, arcman, force, fmts,
+                     threads=None):
+    """
+    Run the handler extraction (and post-extract formatters) of an archive
+
+    The given number of threads applies unless the archive's
+    configuration sets its own.
+    """
+    from .handlers import get_handler
+    handler = get_handler(hname)
+    options, threads = _threads_option(handler, options, threads)
+    if getattr(handler, 'streams_formatters', False):
+        # The handler formats files as it writes them
+        arch = handler(arcf, arcloc, manifest=arcman, formatters=fmts,
+                       **options)
+        fmts = []
+    else:
+        arch = handler(arcf, arcloc, manifest=arcman, **options)
+    with timings.phase('handler.extract'):
+        files = list(_entries(arch.extract(force=force)))
+    if fmts:
+        with timings.phase('post_extract'):
+            _format_files([filename for filename, entry in files
+                           if entry is not None and filename != arcloc],
+                          fmts, threads)
+        files = [(filename, _formatted_entry(filename, entry)
+                  if entry is not None and entry.crc is not None
+                  and filename != arcloc
+                  and any(regex.match(filename) for regex, fmt in fmts)
+                  and os.path.isfile(filename) else entry)
+                 for filename, entry in files]
+    return files
+
+def _formatted_entry(filename, entry):
+    """
+    Get the index entry of a file rewritten by post-extract formatters,
+    keeping its member's size and CRC32 alongside the file's own
+    """
+    from .handlers import file_crc32
+    stat = file_stat(filename)
+    crc = file_crc32(filename)
+    if (stat.size, crc) == (entry.size, entry.crc):
+        return entry._replace(timestamp=stat.mtime)
+    return IndexEntry(stat.mtime, stat.size, crc, entry.size, entry.crc)
+
+def _threads_option(handler, options, threads):
+    """
+    Get the handler options and number of threads for an archive, giving
+    the handler the number of threads (if it uses one) unless its
+    configuration sets its own
+    """
+    if 'threads' in options:
+        return options, options['threads']
+    if threads is not None and getattr(handler, 'uses_threads', False):
+        options = dict(options, threads=threads)
+    return options, threads
+
+def _format_file(filename, fmts):
+    for regex, fmt in fmts: # post-extract formatters
+        if regex.match(filename):
+            logging.debug("Post-extraction: %s(%s)", fmt, filename)
+            fmt(filename)
+
+def _format_files(filenames, fmts, threads=None):
+    """
+    Run post-extract formatters over a batch of extracted files in a
+    thread pool
+    """
+    threads = threads or os.cpu_count() or 1
+    if threads > 1 and len(filenames) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for future in [pool.submit(_format_file, filename, fmts)
+                           for filename in filenames]:
+                future.result()
+    else:
+        for filename in filenames:
+            _format_file(filename, fmts)
+
+def _post_extract(config, cached=True):
+    """
+    Get the post-extract (compiled regex, formatter) pairs, wrapped to use
+    the formatter cache (if cached), and the cache (or None)
+
+    Only formatters that work on files are cached: streaming formatters
+    are cheap enough to run again, and caching them would hold each
+    member in memory and write its output twice.
+    """
+    if 'post_extract' not in config:
+        return [], None
+    from .formatters import CachedFormatter, get_formatter
+    logging.debug("Compiling post-extraction regular expressions")
+    fmts = [(re.compile(regex), get_formatter(fname)) \
+        for regex, fname in config['post_extract']]
+    cache = load_formatter_cache(config) if cached else None
+    if cache is not None:
+        fmts = [(regex, CachedFormatter(fname, fmt, cache)
+                 if getattr(fmt, 'transform', None) is None else fmt) \
+            for (regex, fmt), (_, fname) \
+            in zip(fmts, config['post_extract'])]
+    return fmts, cache
+
+def extract(args, config, index=None, manifest=None):
+    """
+    Extract musdex tracked archive files
+    """
+    if index is None:
+        index = load_index(config)
+    index_updated = False
 
+    fmts, cache = _post_extract(config)
+
+    if args.archive:
+        args.archive = [os.path.relpath(arc) for arc in args.archive]
+    if _hook_mode(args):
+        args.archive = _changed_archives(args, config)
+        if not args.archive:
+            logging.debug("No archives affected by the changes")
+            return
+
+    if manifest is None:
+        manifest = vcs.manifest(config)
+    batch = vcs.Batch(config, manifest)
+
+    tasks = []
     for archive in config['archives']:
         arcf = archive['filename']
         arcloc = os.path.join(BASEDIR, arcf)
@@ -124,47 +425,114 @@ def extract(args, config):
 
         # Check if up to date
         if not args.force and arcloc in index \
-        and _mtime(arcf) <= index[arcloc]:
+        and _mtime(arcf) <= index[arcloc].timestamp:
             continue
 
         arcman = dict((f, index[f] if f in index else None) \
-            for f in manifest if f.startswith(arcloc))
+            for f in manifest.under(arcloc + os.sep))
 
         hname = archive['handler'] if 'handler' in archive else None
-        handler = get_handler(hname)
-        arch = handler(arcf, arcloc, manifest=arcman)
-        files = arch.extract(force=args.force or arcloc not in index)
+        tasks.append(((arcf, arcloc, arcman),
+                      (arcf, arcloc, hname, _handler_options(archive), arcman,
+                       args.force or arcloc not in index, fmts)))
+
+    failures = []
+    jobs = _jobs(args)
+    for (arcf, arcloc, arcman), files, err \
+    in _run_jobs(_extract_archive, _with_threads(tasks, jobs), jobs,
+                 'archive.extract'):
+        if err is not None:
+            failures.append((arcf, err))
+            continue
         if files:
             index_updated = True
 
-        for filename, timestamp in files:
-            if timestamp is None: # File was removed
+        for filename, entry in files:
+            if entry is None: # File was removed
                 del index[filename]
-                vcs.remove_file(config, filename)
+                batch.remove_file(filename)
                 continue
-            index[filename] = timestamp
-            for regex, fmt in fmts: # post-extract formatters
-                if regex.match(filename):
-                    logging.debug("Post-extraction: %s(%s)", fmt, filename)
-                    fmt(filename)
+            index[filename] = entry
             if filename != arcloc and filename not in arcman:
-                vcs.add_file(config, filename)
+                batch.add_file(filename)
 
+    batch.flush()
     if index_updated:
         save_index(config, index)
+    if cache is not None:
+        with timings.phase('formatter_cache.prune'):
+            cache.prune()
+
+    return _report_failures('extract', failures)
+
+def _link_backup(arcf, bakfilename):
+    """
+    Keep the current archive as a backup by hard linking it, copying it
+    only where hard links aren't supported
+    """
+    logging.debug('Backing up %s', arcf)
+    if os.path.lexists(bakfilename):
+        os.remove(bakfilename)
+    try:
+        os.link(arcf, bakfilename)
+    except OSError:
+        shutil.copyfile(arcf, bakfilename)
+
+def _combine_archive(arcf, arcloc, hname, options, arcman, force, backup,
+                     leave_backups, stats, threads=None):
+    """
+    Run the handler combination of an archive, with optional backup
+    """
+    from .handlers import get_handler
+    handler = get_handler(hname)
+    options = _threads_option(handler, options, threads)[0]
+    bakfilename = None
+    if getattr(handler, 'atomic', False):
+        # The old archive is left untouched until the handler swaps the
+        # new one in, so a backup is only needed if it is to be kept
+        if backup and leave_backups and os.path.exists(arcf):
+            with timings.phase('backup'):
+                _link_backup(arcf, arcf + '.bak~')
+    elif backup and os.path.exists(arcf):
+        logging.debug('Backing up %s', arcf)
+        bakfilename = arcf + '.bak~'
+        with timings.phase('backup'):
+            shutil.copyfile(arcf, bakfilename)
 
-def combine(args, config):
+    if getattr(handler, 'uses_stats', False):
+        # The handler reuses the file stats of the staleness check
+        options = dict(options, stats=stats)
+    arch = handler(arcf, arcloc, manifest=arcman, **options)
+    with timings.phase('handler.combine'):
+        files = list(_entries(arch.combine(force=force)))
+
+    if bakfilename is not None and not leave_backups:
+        logging.debug('Removing backup %s', bakfilename)
+        os.remove(bakfilename)
+    return files
+
+def combine(args, config, index=None, manifest=None):
     """
     Combine musdex tracked index files
     """
-    index = load_index(config)
+    if index is None:
+        index = load_index(config)
     index_updated = False
 
     if args.archive:
-        args.archive = map(os.path.relpath, args.archive)
-
-    manifest = vcs.manifest(config)
-
+        args.archive = [os.path.relpath(arc) for arc in args.archive]
+    if _hook_mode(args):
+        args.archive = _changed_archives(args, config)
+        if not args.archive:
+            logging.debug("No archives affected by the changes")
+            return
+
+    if manifest is None:
+        manifest = vcs.manifest(config)
+    backup = 'backup' not in config or config['backup']
+    leave_backups = 'leave_backups' in config and config['leave_backups']
+
+    tasks = []
     for archive in config['archives']:
         arcf = archive['filename']
         arcloc = os.path.join(BASEDIR, arcf)
@@ -172,39 +540,391 @@ def combine(args, config):
             continue
 
         arcman = dict((f, index[f] if f in index else None) \
-            for f in manifest if f.startswith(arcloc))
+            for f in manifest.under(arcloc + os.sep))
 
         logging.debug("Checking modification times for %s", arcf)
         # Unless forced or first-time combination, we do a quick sanity
         # check to see if any of the archive's files have changed
-        if not args.force and arcloc in index and not \
-        any(_mtime(f) > arcman[f] if arcman[f] is not None else True \
-        for f in arcman):
+        scan = TreeScan(arcloc)
+        touched = {}
+        with timings.phase('scan', arcf):
+            changed = args.force or arcloc not in index \
+                or _tree_changed(scan, arcman, touched)
+        if not changed:
+            if touched:
+                index.update(touched)
+                index_updated = True
             continue
 
-        bakfilename = None
-        if ('backup' not in config or config['backup']) \
-        and os.path.exists(arcf):
-            logging.debug('Backing up %s', arcf)
-            bakfilename = arcf + '.bak~'
-            shutil.copyfile(arcf, bakfilename)
-
         hname = archive['handler'] if 'handler' in archive else None
-        handler = get_handler(hname)
-        arch = handler(arcf, arcloc, manifest=arcman)
-        files = arch.combine(force=args.force or arcloc not in index)
+        # An archive modified since it was last indexed can't be trusted
+        # for incremental combination
+        force = args.force or arcloc not in index \
+            or (os.path.exists(arcf)
+                and _mtime(arcf) > index[arcloc].timestamp)
+        with timings.phase('scan', arcf):
+            stats = scan.complete()
+        tasks.append((arcf, (arcf, arcloc, hname, _handler_options(archive),
+                             arcman, force, backup, leave_backups, stats)))
+
+    failures = []
+    jobs = _jobs(args)
+    for arcf, files, err \
+    in _run_jobs(_combine_archive, _with_threads(tasks, jobs), jobs,
+                 'archive.combine'):
+        if err is not None:
+            failures.append((arcf, err))
+            continue
         if files:
             index_updated = True
 
-        for filename, timestamp in files:
-            index[filename] = timestamp
-
-        if bakfilename is not None and ('leave_backups' not in config
-                                        or not config['leave_backups']):
-            logging.debug('Removing backup %s', bakfilename)
-            os.remove(bakfilename)
+        for filename, entry in files:
+            index[filename] = entry
 
     if index_updated:
         save_index(config, index)
 
+    return _report_failures('combine', failures)
+
+def _archive_status(arcf, arcloc, index, indexed):
+    """
+    Check whether an archive needs extraction and/or combination, from
+    the index and file stats alone
+    """
+    status = {'archive': arcf, 'missing': False, 'extract': False,
+              'combine': False}
+    if not os.path.exists(arcf):
+        status['missing'] = True
+    elif arcloc not in index or _mtime(arcf) > index[arcloc].timestamp:
+        status['extract'] = True
+    if arcloc in index:
+        entries = dict((f, index[f]) for f in indexed.under(arcloc + os.sep))
+        scan = TreeScan(arcloc)
+        # Without asking the VCS, a file that was never indexed may be a
+        # new file to combine (musdex's own temporary files end with ~)
+        status['combine'] = _tree_changed(scan, entries, {}) \
+            or any(filename not in entries and not filename.endswith('~')
+                   for filename in scan.complete())
+    return status
+
+def status(args, config):
+    """
+    Report which musdex tracked archives need extraction or combination
+    """
+    index = load_index(config, readonly=True)
+
+    if args.archive:
+        args.archive = [os.path.relpath(arc) for arc in args.archive]
+
+    # Only the index is consulted, not the VCS
+    if isinstance(index, SqliteIndex):
+        index.preload()
+    indexed = vcs.Manifest(index.keys())
+
+    results = []
+    for archive in config['archives'] if 'archives' in config else []:
+        arcf = archive['filename']
+        if args.archive and arcf not in args.archive:
+            continue
+        results.append(_archive_status(arcf, os.path.join(BASEDIR, arcf),
+                                       index, indexed))
+
+    if args.json:
+        import json
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        flags = ('M' if result['missing'] else 'E' if result['extract']
+                 else ' ') + ('C' if result['combine'] else ' ')
+        if flags.strip():
+            print('%s %s' % (flags, result['archive']))
+
+def _open_archive(config, arcf):
+    """
+    Create the handler for an archive, with its configured handler and
+    options (or the default handler, for an archive that isn't configured)
+    """
+    from .handlers import get_handler
+    archive = {'filename': arcf}
+    for configured in config['archives'] if 'archives' in config else []:
+        if configured['filename'] == arcf:
+            archive = configured
+    hname = archive['handler'] if 'handler' in archive else None
+    handler = get_handler(hname)
+    return handler(arcf, os.path.join(BASEDIR, arcf),
+                   **_handler_options(archive))
+
+def _member_stale(entry, timestamp, size, crc):
+    if entry is None:
+        return True
+    member_size, member_crc = member_size_crc(entry)
+    if member_crc is not None and member_size is not None:
+        return member_crc != crc or member_size != size
+    return timestamp > entry.timestamp
+
+def ls(args, config):
+    """
+    List the members of archives, and whether they have changed since
+    they were last extracted, without extracting anything
+    """
+    index = load_index(config, readonly=True)
+    archives = [os.path.relpath(arc) for arc in args.archive] \
+        if args.archive else [archive['filename'] for archive
+                              in config['archives']] \
+        if 'archives' in config else []
+
+    results = []
+    failures = []
+    for arcf in archives:
+        arcloc = os.path.join(BASEDIR, arcf)
+        arch = _open_archive(config, arcf)
+        if not hasattr(arch, 'members'):
+            failures.append((arcf, "Handler does not support listing"))
+            continue
+        try:
+            members = [{
+                'member': os.path.relpath(path, arcloc),
+                'size': size,
+                'crc': crc,
+                'timestamp': timestamp,
+                'stale': _member_stale(index[path] if path in index
+                                       else None, timestamp, size, crc),
+            } for path, timestamp, size, crc in arch.members()]
+        except Exception as err:
+            failures.append((arcf, err))
+            continue
+        results.append({'archive': arcf, 'members': members})
+
+    if args.json:
+        import json
+        print(json.dumps(results, indent=2))
+    else:
+        for i, result in enumerate(results):
+            if len(archives) > 1:
+                print('%s%s:' % ('\n' if i else '', result['archive']))
+            for member in result['members']:
+                print('%s %10d %08x %s' % ('E' if member['stale'] else ' ',
+                                           member['size'], member['crc'],
+                                           member['member']))
+    return _report_failures('list', failures)
+
+def cat(args, config):
+    """
+    Write archive members to standard output, without extracting anything
+    """
+    arcf = os.path.relpath(args.archive)
+    arcloc = os.path.join(BASEDIR, arcf)
+    arch = _open_archive(config, arcf)
+    if not hasattr(arch, 'open_member'):
+        logging.error("Handler does not support reading members: %s", arcf)
+        return 1
+    out = sys.stdout.buffer
+    for member in args.member:
+        try:
+            source = arch.open_member(os.path.join(arcloc, member))
+        except KeyError:
+            logging.error("No such member in %s: %s", arcf, member)
+            return 1
+        with source:
+            shutil.copyfileobj(source, out)
+    out.flush()
+
+def _verify_file(arch, path, size, crc, stat, fmts):
+    """
+    Check an extracted file against the size and CRC32 of its member or,
+    for files with post-extract formatters, of its member as formatted
+
+    A formatted file may also match its member as it is, as when it was
+    extracted before the formatters were configured.
+    """
+    import tempfile
+    from .formatters import streaming
+    from .handlers import chunks_crc32, file_crc32
+    filecrc = file_crc32(path)
+    if stat.size == size and filecrc == crc:
+        return True
+    matched = [fmt for regex, fmt in fmts if regex.match(path)]
+    if not matched:
+        return False
+    # Formatters that work on files are given a file of the same name in
+    # a scratch directory, so that nothing is written to the tree
+    with tempfile.TemporaryDirectory(prefix='musdex-verify-') as scratch:
+        name = os.path.join(scratch, os.path.basename(path))
+        with arch.open_member(path) as member:
+            chunks = iter(lambda: member.read(64 * 1024), b'')
+            for fmt in matched:
+                chunks = streaming(fmt, name)(chunks)
+            size, crc = chunks_crc32(chunks)
+    return stat.size == size and filecrc == crc
+
+def verify(args, config):
+    """
+    Check that the extracted files of musdex tracked archives match the
+    archives, without extracting or writing anything
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    archives = [archive['filename'] for archive in config['archives']] \
+        if 'archives' in config else []
+    if args.archive:
+        args.archive = [os.path.relpath(arc) for arc in args.archive]
+        archives = [arcf for arcf in archives if arcf in args.archive]
+    # Uncached, as the formatter cache is written to even when it is read
+    fmts, cache = _post_extract(config, cached=False)
+
+    results = []
+    failures = []
+    with ThreadPoolExecutor(max_workers=_jobs(args)) as pool:
+        for arcf in archives:
+            arcloc = os.path.join(BASEDIR, arcf)
+            arch = _open_archive(config, arcf)
+            if not hasattr(arch, 'members') \
+            or (fmts and not hasattr(arch, 'open_member')):
+                failures.append((arcf, "Handler does not support verifying"))
+                continue
+            try:
+                members = dict((path, (size, crc)) for path, timestamp,
+                               size, crc in arch.members())
+            except Exception as err:
+                failures.append((arcf, err))
+                continue
+            stats = TreeScan(arcloc).complete()
+            # CRCs of the files (of every archive) are computed in the pool
+            checks = [(path, pool.submit(_verify_file, arch, path, size, crc,
+                                         stats[path], fmts))
+                      for path, (size, crc) in sorted(members.items())
+                      if path in stats]
+            results.append((arcf, members, stats, checks))
+
+    report = []
+    for arcf, members, stats, checks in results:
+        mismatched = []
+        for path, check in checks:
+            try:
+                if not check.result():
+                    mismatched.append(path)
+            except Exception as err:
+                failures.append((arcf, err))
+        report.append({
+            'archive': arcf,
+            'missing': sorted(path for path in members if path not in stats),
+            'extra': sorted(path for path in stats if path not in members),
+            'mismatched': mismatched,
+        })
+
+    if args.json:
+        import json
+        print(json.dumps(report, indent=2))
+    else:
+        for result in report:
+            for problem in ('missing', 'extra', 'mismatched'):
+                for path in result[problem]:
+                    print('%s %s' % (problem, path))
+    drifted = [result['archive'] for result in report
+               if result['missing'] or result['extra'] or result['mismatched']]
+    for arcf in drifted:
+        logging.warning("Extracted files of %s don't match the archive", arcf)
+    logging.info("Verified %d archive(s)", len(report))
+    return _report_failures('verify', failures) or (1 if drifted else None)
+
+def _watched_archives(args, config):
+    archives = [archive['filename'] for archive in config['archives']] \
+        if 'archives' in config else []
+    if args.archive:
+        archives = [arcf for arcf in archives if arcf in args.archive]
+    return archives
+
+def _process_changes(config, index, manifest, changed, archives):
+    """
+    Extract the archives whose files changed and combine the archives
+    whose extracted files changed
+    """
+    extracts = set()
+    combines = set()
+    for path in changed:
+        found = _path_archive(path, archives)
+        if found is not None:
+            (extracts if found[1] else combines).add(found[0])
+    conflicts = extracts & combines
+    for arcf in sorted(conflicts):
+        logging.warning("Both %s and its extracted files changed; "
+                        "extract or combine it by hand", arcf)
+
+    for func, selected in ((extract, extracts), (combine, combines)):
+        selected = sorted(selected - conflicts)
+        if selected:
+            func(argparse.Namespace(archive=selected, force=False, jobs=1,
+                                    changed=False, changed_from=None),
+                 config, index, manifest)
+
+def _stale_paths(index, archives):
+    """
+    Find the changes to act on when the changes themselves weren't
+    followed: each archive changed since it was last extracted, and the
+    location of each archive whose extracted files changed
+    """
+    indexed = vcs.Manifest(index.keys())
+    changed = set()
+    for arcf in archives:
+        arcloc = os.path.join(BASEDIR, arcf)
+        status = _archive_status(arcf, arcloc, index, indexed)
+        if status['extract']:
+            changed.add(arcf)
+        if status['combine']:
+            changed.add(arcloc)
+    return changed
+
+def watch(args, config):
+    """
+    Watch musdex tracked archives and their extracted files, extracting or
+    combining each archive as it changes
+    """
+    from .watch import Overflow, get_watcher
+    if args.archive:
+        args.archive = [os.path.relpath(arc) for arc in args.archive]
+    conf = os.path.normpath(args.config or DEFAULT_CONFIG)
+    index = load_index(config)
+    # Like the index, the manifest stays loaded, and extraction keeps it
+    # up to date with the files it adds and removes
+    manifest = vcs.manifest(config)
+    watcher = get_watcher(args.poll, args.interval)
+
+    archives = _watched_archives(args, config)
+    watcher.watch(archives + [conf],
+                  [os.path.join(BASEDIR, arcf) for arcf in archives])
+    logging.info("Watching %d archive(s) for changes", len(archives))
+    try:
+        while True:
+            try:
+                changed = watcher.read()
+                # Wait for a burst of changes (such as saving a whole
+                # directory of files) to settle
+                while True:
+                    more = watcher.read(args.debounce)
+                    if not more:
+                        break
+                    changed |= more
+            except Overflow:
+                logging.warning("Too many changes to follow, "
+                                "checking every archive")
+                changed = _stale_paths(index, archives)
+
+            if conf in changed:
+                logging.info("Reloading configuration from %s", conf)
+                config = load_config(args)
+                index = load_index(config)
+                manifest = vcs.manifest(config)
+                archives = _watched_archives(args, config)
+                watcher.watch(archives + [conf],
+                              [os.path.join(BASEDIR, arcf)
+                               for arcf in archives])
+
+            # Changes musdex makes itself are seen as well, but then find
+            # the archives already up to date
+            _process_changes(config, index, manifest, changed, archives)
+    except KeyboardInterrupt:
+        logging.info("No longer watching for changes")
+    finally:
+        watcher.close()
+
 # vim: ai et ts=4 sts=4 sw=4
@@ -8,11 +8,21 @@ import os
 import os.path
 import yaml
 
-from . import vcs
+from .index import SqliteIndex, stored_entry, to_entry
+from . import timings, vcs
+
+# libyaml's C loader and dumper are much quicker, where available
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
 
 BASEDIR = "_musdex"
 DEFAULT_CONFIG = os.path.join(BASEDIR, "musdex.yaml")
 DEFAULT_INDEX = os.path.join(BASEDIR, ".musdex.index.yaml")
+DEFAULT_SQLITE_INDEX = os.path.join(BASEDIR, ".musdex.index.sqlite")
+DEFAULT_FORMATTER_CACHE = os.path.join(BASEDIR, ".musdex.cache")
+DEFAULT_FORMATTER_CACHE_SIZE = 64 * 1024 * 1024
 
 def load_config(args):
     """
@@ -26,7 +36,7 @@ def load_config(args):
         logging.info("No configuration file found at %s", conf)
         return {}
     configfile = open(conf, 'r')
-    config = yaml.load(configfile)
+    config = yaml.load(configfile, Loader=SafeLoader)
     configfile.close()
     return config
 
@@ -44,30 +54,75 @@ def save_config(args, config):
         os.makedirs(confdir)
     new_conf = not os.path.exists(conf)
     configfile = open(conf, 'w')
-    yaml.dump(config, configfile)
+    yaml.dump(config, configfile, Dumper=SafeDumper)
     configfile.close()
     if new_conf:
         logging.info("Adding new configuration file to vcs: %s", conf)
         vcs.add_file(config, conf)
 
-# TODO: Perhaps the index should instead be a less verbose format?
-def load_index(config):
+def _index_format(config):
+    return config['index_format'] if 'index_format' in config else 'yaml'
+
+def _load_yaml_index(filename):
+    logging.debug("Loading existing index: %s", filename)
+    indexfile = open(filename, 'r')
+    index = yaml.load(indexfile, Loader=SafeLoader)
+    indexfile.close()
+    return dict((filename, to_entry(entry)) \
+        for filename, entry in (index or {}).items())
+
+def _sqlite_index(config):
+    """
+    Find the SQLite index, alongside the configured (YAML) index
+    """
+    if 'index' not in config:
+        return DEFAULT_SQLITE_INDEX
+    return os.path.splitext(config['index'])[0] + '.sqlite'
+
+@timings.timed('index.load')
+def load_index(config, readonly=False):
     """
     Load the index information (timestamp cache manifest)
+
+    Read-only commands neither create nor migrate a SQLite index.
     """
-    index = config['index'] if 'index' in config else DEFAULT_INDEX
-    if os.path.exists(index):
-        logging.debug("Loading existing index: %s", index)
-        indexfile = open(index, 'r')
-        index = yaml.load(indexfile)
-        indexfile.close()
+    yamlindex = config['index'] if 'index' in config else DEFAULT_INDEX
+    fmt = _index_format(config)
+    if fmt == 'sqlite':
+        index = _sqlite_index(config)
+        migrate = not os.path.exists(index) and index != yamlindex \
+            and os.path.exists(yamlindex)
+        if readonly and not os.path.exists(index):
+            return _load_yaml_index(yamlindex) if migrate else {}
+        idxdir = os.path.dirname(index)
+        if idxdir and not os.path.exists(idxdir):
+            logging.info("Index directory does not exist: %s", idxdir)
+            os.makedirs(idxdir)
+        index = SqliteIndex(index)
+        if migrate:
+            logging.info("Migrating index %s to %s", yamlindex,
+                         index.filename)
+            index.update_all(_load_yaml_index(yamlindex).items())
+            index.save()
+            os.remove(yamlindex)
         return index
+    elif fmt != 'yaml':
+        raise ValueError("Unknown index format: %s" % fmt)
+
+    if os.path.exists(yamlindex):
+        return _load_yaml_index(yamlindex)
     return {}
 
+@timings.timed('index.save')
 def save_index(config, index):
     """
     Save the index information (timestamp cache manifest)
     """
+    if isinstance(index, SqliteIndex):
+        logging.debug("Saving index: %s", index.filename)
+        index.save()
+        return
+
     idx = config['index'] if 'index' in config else DEFAULT_INDEX
     logging.debug("Saving index: %s", idx)
     idxdir = os.path.dirname(idx)
@@ -75,7 +130,23 @@ def save_index(config, index):
         logging.info("Index directory does not exist: %s", idxdir)
         os.makedirs(idxdir)
     indexfile = open(idx, 'w')
-    yaml.dump(index, indexfile)
+    # Entries are stored as plain [timestamp, size, crc] lists (followed by
+    # the member size and crc, for formatted files)
+    yaml.dump(dict((filename, stored_entry(entry)) \
+        for filename, entry in index.items()), indexfile, Dumper=SafeDumper)
     indexfile.close()
 
+def load_formatter_cache(config):
+    """
+    Get the formatter output cache, or None if it is disabled
+    """
+    from .cache import FormatterCache
+    if 'formatter_cache' in config and not config['formatter_cache']:
+        return None
+    directory = config['formatter_cache_dir'] \
+        if 'formatter_cache_dir' in config else DEFAULT_FORMATTER_CACHE
+    limit = config['formatter_cache_size'] \
+        if 'formatter_cache_size' in config else DEFAULT_FORMATTER_CACHE_SIZE
+    return FormatterCache(directory, limit)
+
 # vim: ai et ts=4 sts=4 sw=4
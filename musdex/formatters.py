@@ -9,6 +9,104 @@ import os
 import os.path
 import sys
 import subprocess
+import tempfile
+import xml.parsers.expat
+
+from .xmlformat import format_xml
+
+CHUNK_SIZE = 64 * 1024
+
+def _read_chunks(f):
+    return iter(lambda: f.read(CHUNK_SIZE), b'')
+
+def format_file(filename, transform):
+    """
+    Apply a streaming transform to a file in place
+    """
+    bakfile = "%s.bak~" % filename
+    os.rename(filename, bakfile)
+    with open(bakfile, 'rb') as inf, open(filename, 'wb') as outf:
+        for chunk in transform(_read_chunks(inf)):
+            outf.write(chunk)
+    os.remove(bakfile)
+
+def _temporary_file(filename=None):
+    """
+    Create a temporary file to format the given file in: alongside it,
+    named after it and with the same extension, so that formatters that go
+    by the extension (or write files next to their input) still work
+    """
+    if filename is None:
+        return tempfile.mkstemp(suffix='.musdex~')
+    directory, name = os.path.split(filename)
+    root, ext = os.path.splitext(name)
+    if directory and not os.path.isdir(directory):
+        directory = None
+    return tempfile.mkstemp(suffix=ext, prefix='.%s.musdex~' % root,
+                            dir=directory or os.curdir)
+
+def _file_adapter(formatter, filename=None):
+    """
+    Adapt a filename-based formatter to a streaming transform by way of a
+    temporary file for the given file
+    """
+    def transform(chunks):
+        fd, tmpname = _temporary_file(filename)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in chunks:
+                    tmp.write(chunk)
+            formatter(tmpname)
+            with open(tmpname, 'rb') as tmp:
+                for chunk in _read_chunks(tmp):
+                    yield chunk
+        finally:
+            os.remove(tmpname)
+    return transform
+
+def streaming(formatter, filename=None):
+    """
+    Get the streaming transform for a formatter, for the content of the
+    given file
+
+    A streaming formatter provides a transform attribute: a function from
+    an iterable of byte chunks to an iterable of (formatted) byte chunks.
+    Other formatters are adapted to run against a temporary file.
+    """
+    if isinstance(formatter, CachedFormatter):
+        return lambda chunks: formatter.transform(chunks, filename)
+    transform = getattr(formatter, 'transform', None)
+    return transform if transform is not None \
+        else _file_adapter(formatter, filename)
+
+class CachedFormatter(object):
+    """
+    Wrap a formatter so that its output is taken from a FormatterCache when
+    the same raw content has been formatted before
+    """
+
+    def __init__(self, name, formatter, cache):
+        self.name = name
+        self.formatter = formatter
+        self.cache = cache
+
+    def transform(self, chunks, filename=None):
+        data = b''.join(chunks)
+        key = self.cache.key(self.name, data)
+        output = self.cache.get(key)
+        if output is None:
+            output = b''.join(streaming(self.formatter, filename)([data]))
+            self.cache.put(key, output)
+        else:
+            logging.debug("Using cached %s output", self.name)
+        yield output
+
+    def __call__(self, filename):
+        format_file(filename,
+                    lambda chunks: self.transform(chunks, filename))
+
+    def __repr__(self):
+        return '<cached %r>' % self.formatter
 
 def xmllint(filename):
     """
@@ -16,21 +114,34 @@ def xmllint(filename):
     """
     subprocess.call(['xmllint', '--format', '--output', filename, filename])
 
+def _xmlformat(chunks):
+    data = b''.join(chunks)
+    try:
+        yield format_xml(data)
+    except (ValueError, xml.parsers.expat.ExpatError) as err:
+        logging.warning("Unable to format XML, leaving it as is: %s", err)
+        yield data
+
+def xmlformat(filename):
+    """
+    Pretty-print an XML file in-process, as xmllint --format would
+    """
+    format_file(filename, _xmlformat)
+xmlformat.transform = _xmlformat
+
+def _remove_carriage_returns(chunks):
+    for chunk in chunks:
+        yield chunk.replace(b'\r', b'')
+
 def remove_carriage_returns(filename):
     """
     Remove carriage returns (\r) from file
     """
-    bakfile = "%s.bak~" % filename
-    os.rename(filename, bakfile)
-    inf = open(bakfile, 'rb')
-    outf = open(filename, 'wb')
-    for line in inf:
-        outf.write(line.replace('\r', ''))
-    inf.close()
-    outf.close()
-    os.remove(bakfile)
+    format_file(filename, _remove_carriage_returns)
+remove_carriage_returns.transform = _remove_carriage_returns
 
-FORMATTER_CACHE = {'xmllint': xmllint, 'removecrs': remove_carriage_returns}
+FORMATTER_CACHE = {'xmllint': xmllint, 'xmlformat': xmlformat,
+                   'removecrs': remove_carriage_returns}
 
 def get_formatter(name=None):
     """
@@ -3,26 +3,455 @@ File-type handlers for musdex
 """
 # Copyright 2010 Max Battcher. Some rights reserved.
 # Licensed for use under the Ms-RL. See attached LICENSE file.
-import datetime
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from stat import S_ISDIR
+import fnmatch
 import importlib
 import logging
+import mmap
+import os
 import os.path
+import shutil
+import struct
 import sys
+import tempfile
 import time
 import zipfile
+import zlib
 
-def _datetime_from_epoch(epoch):
-    return datetime.datetime(*time.localtime(epoch)[:6])
+from .formatters import streaming
+from .index import member_size_crc
+from .scan import file_stat
+
+# Local file header field positions (see zipfile.structFileHeader)
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+_MASK_USE_DATA_DESCRIPTOR = 0x08
+_EXTRA_ZIP64 = 0x0001
+_EXTRA_TIMESTAMP = 0x5455 # "UT" extended timestamp
+_UT_MTIME = 0x01
+_COPY_CHUNK = 64 * 1024
+_MASK_ENCRYPTED = 0x01
+_MASK_LZMA_EOS = 0x02 # LZMA data ends with an end of stream marker
+
+# Whether the kernel can copy between files without going through Python
+_ZERO_COPY = hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile')
+
+COMPRESSION_METHODS = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+# The compression levels each method accepts (auto deflates or stores)
+_LEVELS = {
+    'deflate': range(-1, 10),
+    'auto': range(-1, 10),
+    'bzip2': range(1, 10),
+    'lzma': range(0, 10),
+}
+# In auto mode, members whose first chunk doesn't deflate to less than
+# this fraction of its size (such as images or nested archives) are stored
+AUTO_STORE_RATIO = 0.9
+# Compressed members are kept in memory up to this size and spooled to a
+# temporary file beyond it, until they are written in order
+_SPOOL_SIZE = 1024 * 1024
+# Combining compresses members ahead of writing them until they add up to
+# this many (uncompressed) bytes
+_WINDOW_BYTES = 64 * 1024 * 1024
+
+def _extra_fields(extra):
+    """
+    Split a zip extra field into (header id, data) pairs
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        hid, size = struct.unpack('<HH', extra[pos:pos + 4])
+        yield hid, extra[pos + 4:pos + 4 + size]
+        pos += 4 + size
+
+def _timestamp_extra(mtime):
+    """
+    Build an extended timestamp extra field for a modification time in
+    (whole) seconds since the epoch
+    """
+    if not -2 ** 31 <= mtime < 2 ** 31:
+        return b''
+    return struct.pack('<HHBl', _EXTRA_TIMESTAMP, 5, _UT_MTIME, mtime)
+
+def member_timestamp(info):
+    """
+    Find the modification time of a zip member in nanoseconds since the
+    epoch
+
+    The extended timestamp extra field (UTC, to the second) is preferred
+    over the member's DOS date and time (local time, to two seconds).
+    """
+    for hid, data in _extra_fields(info.extra):
+        if hid == _EXTRA_TIMESTAMP and len(data) >= 5 \
+        and data[0] & _UT_MTIME:
+            return struct.unpack('<l', data[1:5])[0] * 10 ** 9
+    return int(time.mktime(info.date_time + (0, 0, -1))) * 10 ** 9
+
+def file_crc32(filename):
+    """
+    Compute the CRC32 of a file's content (as stored in zip archives)
+    """
+    with open(filename, 'rb') as f:
+        return chunks_crc32(iter(lambda: f.read(_COPY_CHUNK), b''))[1]
+
+def chunks_crc32(chunks):
+    """
+    Compute the size and CRC32 of content given as byte chunks
+    """
+    size = 0
+    crc = 0
+    for chunk in chunks:
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+    return size, crc
+
+def _written(chunks, dest):
+    """
+    Write chunks to a file, passing them on
+    """
+    for chunk in chunks:
+        dest.write(chunk)
+        yield chunk
+
+def _member_changed(entry, info):
+    """
+    Check an archive member against the index entry of its extracted file
+
+    The central directory already records a CRC32 for every member, so
+    when the index knows the member's size and CRC32 we compare those
+    instead of timestamps.
+    """
+    if entry is None:
+        return True
+    size, crc = member_size_crc(entry)
+    if crc is not None and size is not None:
+        return crc != info.CRC or size != info.file_size
+    return member_timestamp(info) > entry.timestamp
+
+def _strip_extra(extra, ids):
+    """
+    Remove the given header ids from a zip extra field
+    """
+    return b''.join(struct.pack('<HH', hid, len(data)) + data
+                    for hid, data in _extra_fields(extra) if hid not in ids)
+
+def _data_offset(ziparchive, info):
+    """
+    Find the offset of a member's (compressed) data in the archive file
+    """
+    ziparchive.fp.seek(info.header_offset)
+    fheader = ziparchive.fp.read(zipfile.sizeFileHeader)
+    if len(fheader) != zipfile.sizeFileHeader \
+    or fheader[0:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad local file header: %s" % info.filename)
+    fheader = struct.unpack(zipfile.structFileHeader, fheader)
+    return info.header_offset + zipfile.sizeFileHeader \
+        + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH]
+
+def _copy_range(src_fd, offset, count, dest):
+    """
+    Copy count bytes at offset of a file descriptor to the current position
+    of the (buffered) dest file, inside the kernel where possible
+    """
+    dest.flush()
+    pos = dest.tell()
+    dst_fd = dest.fileno()
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < count:
+                n = os.copy_file_range(src_fd, dst_fd, count - copied,
+                                       offset + copied, pos + copied)
+                if not n:
+                    break
+                copied += n
+        except OSError as err:
+            logging.debug("copy_file_range failed: %s", err)
+    if copied < count and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dst_fd, pos + copied, os.SEEK_SET)
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, offset + copied,
+                                count - copied)
+                if not n:
+                    break
+                copied += n
+        except OSError as err:
+            logging.debug("sendfile failed: %s", err)
+    while copied < count:
+        chunk = os.pread(src_fd, min(count - copied, _COPY_CHUNK),
+                         offset + copied)
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated member data")
+        os.pwrite(dst_fd, chunk, pos + copied)
+        copied += len(chunk)
+    dest.seek(pos + count)
+
+def _register(dest, zinfo):
+    """
+    Register a member written directly to a zip for its central directory
+    """
+    dest.filelist.append(zinfo)
+    dest.NameToInfo[zinfo.filename] = zinfo
+    dest.start_dir = dest.fp.tell()
+    return zinfo
+
+def _write_raw(dest, zinfo, chunks):
+    """
+    Write a member's already-compressed data chunks into a zip
+
+    zipfile has no public API for this, so we write the local header and
+    data ourselves and register the member for the central directory.
+    """
+    zinfo.header_offset = dest.fp.tell()
+    dest.fp.write(zinfo.FileHeader())
+    for chunk in chunks:
+        dest.fp.write(chunk)
+    return _register(dest, zinfo)
+
+def _read_raw(source, info, offset=None):
+    """
+    Read a member's compressed data from a zip in chunks
+    """
+    if offset is None:
+        offset = _data_offset(source, info)
+    source.fp.seek(offset)
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.fp.read(min(remaining, _COPY_CHUNK))
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated member: %s" % info.filename)
+        remaining -= len(chunk)
+        yield chunk
+
+def _copy_raw(source, info, dest):
+    """
+    Copy a member's already-compressed bytes from one zip to another
+    """
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.extra = _strip_extra(info.extra, (_EXTRA_ZIP64,))
+    zinfo.create_system = info.create_system
+    zinfo.internal_attr = info.internal_attr
+    zinfo.external_attr = info.external_attr
+    zinfo.flag_bits = info.flag_bits & ~_MASK_USE_DATA_DESCRIPTOR
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    offset = _data_offset(source, info)
+    if not _ZERO_COPY:
+        return _write_raw(dest, zinfo, _read_raw(source, info, offset))
+    zinfo.header_offset = dest.fp.tell()
+    dest.fp.write(zinfo.FileHeader())
+    _copy_range(source.fp.fileno(), offset, info.compress_size, dest.fp)
+    return _register(dest, zinfo)
+
+def _check_level(method, level):
+    if level is None or method not in _LEVELS:
+        return
+    levels = _LEVELS[method]
+    if not isinstance(level, int) or level not in levels:
+        raise ValueError("Compression level for %s must be from %d to %d: "
+                         "%r" % (method, levels[0], levels[-1], level))
+
+class CompressionPolicy(object):
+    """
+    CompressionPolicy picks the compression method and level for each
+    member by the first matching glob of its rules
+
+    The compression handler option is either a method name for every
+    member or a list of [glob, method] or [glob, method, level] rules.
+    Members that match no rule are deflated.
+    """
+
+    def __init__(self, compression=None, level=None):
+        if compression is None:
+            compression = 'deflate'
+        if isinstance(compression, str):
+            compression = [['*', compression]]
+        self.rules = []
+        for rule in compression:
+            glob, method = rule[0], rule[1]
+            if method != 'auto' and method not in COMPRESSION_METHODS:
+                raise ValueError("Unknown compression method: %s" % method)
+            rule_level = rule[2] if len(rule) > 2 else level
+            _check_level(method, rule_level)
+            self.rules.append((glob, method, rule_level))
+        _check_level('deflate', level)
+        self.level = level
+
+    def method(self, arcname):
+        """
+        Find the (method, level) for a member
+        """
+        for glob, method, level in self.rules:
+            if fnmatch.fnmatchcase(arcname, glob):
+                return method, level
+        return 'deflate', self.level
+
+# The LZMA literal context, literal position and position bits of every
+# preset level, and the dictionary size of each (as in liblzma)
+_LZMA_LC, _LZMA_LP, _LZMA_PB = 3, 0, 2
+_LZMA_DICT_SIZES = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22,
+                    1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]
+
+class _LzmaCompressor(object):
+    """
+    Compress raw LZMA data for a zip member, which starts with the LZMA
+    SDK version and the LZMA properties (APPNOTE 5.8.8)
+    """
+
+    def __init__(self, level=None):
+        import lzma
+        level = 6 if level is None else level
+        # The options are given explicitly so that the properties written
+        # to the header match them
+        self.dict_size = _LZMA_DICT_SIZES[level]
+        self.compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[{
+            'id': lzma.FILTER_LZMA1, 'preset': level,
+            'dict_size': self.dict_size, 'lc': _LZMA_LC, 'lp': _LZMA_LP,
+            'pb': _LZMA_PB}])
+        self.header = False
+
+    def _header(self):
+        if self.header:
+            return b''
+        self.header = True
+        properties = struct.pack('<BI', (_LZMA_PB * 5 + _LZMA_LP) * 9
+                                 + _LZMA_LC, self.dict_size)
+        return struct.pack('<BBH', 9, 4, len(properties)) + properties
+
+    def compress(self, data):
+        return self._header() + self.compressor.compress(data)
+
+    def flush(self):
+        return self._header() + self.compressor.flush()
+
+def _compressor(compress_type, level):
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION
+                                if level is None else level,
+                                zlib.DEFLATED, -15)
+    if compress_type == zipfile.ZIP_BZIP2:
+        import bz2
+        return bz2.BZ2Compressor(9 if level is None else level)
+    if compress_type == zipfile.ZIP_LZMA:
+        return _LzmaCompressor(level)
+    raise ValueError("Unknown compression method: %d" % compress_type)
+
+def _compress_file(filename, arcname, stat=None, method='deflate',
+                   level=None):
+    """
+    Compress a file, returning its ZipInfo and its compressed data in a
+    spooled temporary file (or None for a directory)
+
+    This mirrors what ZipFile.write does for a regular file or directory,
+    but also records the modification time in an extended timestamp extra
+    field. zlib (like bz2 and lzma) releases the GIL while compressing, so
+    this may be run in worker threads.
+    """
+    if stat is None:
+        stat = file_stat(filename)
+    mtime = stat.mtime // 10 ** 9
+    arcname = arcname.replace(os.sep, '/')
+    isdir = S_ISDIR(stat.mode)
+    if isdir and not arcname.endswith('/'):
+        arcname += '/'
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(mtime)[:6])
+    zinfo.extra = _timestamp_extra(mtime)
+    zinfo.external_attr = (stat.mode & 0xFFFF) << 16
+    if isdir:
+        # A directory entry is stored empty, with the MS-DOS directory bit
+        zinfo.external_attr |= 0x10
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.CRC = 0
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        return zinfo, None, stat.mtime
+    crc = 0
+    size = 0
+    data = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+    with open(filename, 'rb') as f:
+        chunk = f.read(_COPY_CHUNK)
+        if method == 'auto':
+            # Sample the first chunk with a quick deflate
+            sample = zlib.compress(chunk, 1)
+            method = 'store' if chunk \
+                and len(sample) > len(chunk) * AUTO_STORE_RATIO \
+                else 'deflate'
+        zinfo.compress_type = COMPRESSION_METHODS[method]
+        if zinfo.compress_type == zipfile.ZIP_LZMA:
+            zinfo.flag_bits |= _MASK_LZMA_EOS
+        compressor = _compressor(zinfo.compress_type, level) \
+            if zinfo.compress_type != zipfile.ZIP_STORED else None
+        while chunk:
+            size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            data.write(compressor.compress(chunk)
+                       if compressor is not None else chunk)
+            chunk = f.read(_COPY_CHUNK)
+    if compressor is not None:
+        data.write(compressor.flush())
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = data.tell()
+    data.seek(0)
+    return zinfo, data, stat.mtime
+
+def _replace_file(source, target):
+    """
+    Atomically replace target with the (fully written and synced) source
+    file, keeping target's permissions
+    """
+    if os.path.exists(target):
+        shutil.copymode(target, source)
+    os.replace(source, target)
+    if os.name != 'nt':
+        # Make the rename itself durable
+        fd = os.open(os.path.dirname(target) or os.curdir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def _result(value):
+    """
+    Get the result of a value that may be a pending future
+    """
+    return value.result() if isinstance(value, Future) else value
 
 class ZipArchiveHandler(object):
     """
     ZipArchiveHandler combines and extract zip archives
     """
 
-    def __init__(self, archive, location, manifest=None):
+    # Post-extract formatters are applied while members are decompressed
+    streams_formatters = True
+    # File stats from musdex's scan of the location are reused in combine
+    uses_stats = True
+    # The archive is replaced atomically when combined
+    atomic = True
+    # The threads option is shared out by musdex when running in parallel
+    uses_threads = True
+
+    def __init__(self, archive, location, manifest=None, threads=None,
+                 formatters=None, stats=None, compression=None,
+                 compression_level=None):
         self.archive = archive
         self.location = location
         self.manifest = manifest or {}
+        self.threads = threads or os.cpu_count() or 1
+        self.formatters = formatters or []
+        self.stats = stats or {}
+        self.compression = CompressionPolicy(compression, compression_level)
 
     def check(self):
         """
@@ -35,35 +464,36 @@ class ZipArchiveHandler(object):
         Extract zip file
         """
         manifestfiles = set(self.manifest.keys())
+        ziparchive = zipfile.ZipFile(self.archive)
         if force:
             logging.info("Extracting all of %s", self.archive)
-            ziparchive = zipfile.ZipFile(self.archive)
-            ziparchive.extractall(self.location)
-
-            for info in ziparchive.infolist():
-                path = os.path.relpath(os.path.join(self.location,
-                                                    info.filename))
-                yield (path, datetime.datetime(*info.date_time))
-                if path in manifestfiles:
-                    manifestfiles.remove(path)
         else:
             logging.info("Selectively extracting %s", self.archive)
-            ziparchive = zipfile.ZipFile(self.archive)
 
-            for info in ziparchive.infolist():
-                path = os.path.relpath(os.path.join(self.location,
-                                                    info.filename))
-                timestamp = datetime.datetime(*info.date_time)
-                if path not in self.manifest:
-                    logging.debug("Extracting new file %s", path)
-                    ziparchive.extract(info, self.location)
-                    yield (path, timestamp)
-                elif timestamp > self.manifest[path]:
-                    logging.debug("Extracting updated file %s", path)
-                    ziparchive.extract(info, self.location)
-                    yield (path, timestamp)
-                if path in manifestfiles:
-                    manifestfiles.remove(path)
+        selected = []
+        for info in ziparchive.infolist():
+            path = self._path(info)
+            if path in manifestfiles:
+                manifestfiles.remove(path)
+            if force:
+                pass
+            elif path not in self.manifest:
+                logging.debug("Extracting new file %s", path)
+            elif _member_changed(self.manifest[path], info):
+                logging.debug("Extracting updated file %s", path)
+            else:
+                continue
+            selected.append((path, info))
+
+        for path, info, (timestamp, written) \
+        in self._extract_members(ziparchive, selected):
+            if written is None or written == (info.file_size, info.CRC):
+                yield (path, timestamp, info.file_size, info.CRC)
+            else:
+                # Formatted: the index keeps the size and CRC32 of both the
+                # file and the member
+                yield (path, timestamp) + written \
+                    + (info.file_size, info.CRC)
 
         # Check for removed files
         if manifestfiles:
@@ -71,24 +501,288 @@ class ZipArchiveHandler(object):
                 yield (filename, None)
 
         yield (self.location,
-               _datetime_from_epoch(os.path.getmtime(self.archive)))
+               os.stat(self.archive).st_mtime_ns)
+
+    def members(self):
+        """
+        List the files of the zip from its central directory, without
+        extracting anything
+        """
+        with zipfile.ZipFile(self.archive) as ziparchive:
+            for info in ziparchive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                yield (self._path(info), member_timestamp(info),
+                       info.file_size, info.CRC)
+
+    def open_member(self, path):
+        """
+        Open the member of the zip for a file under the location, reading
+        it by random access through the central directory
+        """
+        with zipfile.ZipFile(self.archive) as ziparchive:
+            info = ziparchive.NameToInfo.get(
+                os.path.relpath(path, self.location).replace(os.sep, '/'))
+            if info is None:
+                infos = [info for info in ziparchive.infolist()
+                         if self._path(info) == os.path.relpath(path)]
+                if not infos:
+                    raise KeyError(path)
+                info = infos[-1]
+            # The member keeps the archive file open until it is closed
+            return ziparchive.open(info)
+
+    def _path(self, info):
+        return os.path.relpath(os.path.join(self.location, info.filename))
+
+    def _extract_members(self, ziparchive, selected):
+        """
+        Extract the selected (path, info) members, yielding them in order
+        with their timestamps and the (size, CRC32) of their formatted
+        content (or None, for members written as they are)
+
+        Members that need formatting are extracted in a thread pool (with
+        their directories created up front), as formatters such as xmllint
+        spend most of their time outside of Python.
+        """
+        pool = None
+        if self.threads > 1 and self.formatters:
+            pool = ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            pending = deque()
+            window = self.threads * 4
+            for path, info in selected:
+                transforms = self._transforms(path) \
+                    if not info.filename.endswith('/') else []
+                if transforms and pool is not None:
+                    targetdir = os.path.dirname(self._target(info))
+                    if targetdir:
+                        os.makedirs(targetdir, exist_ok=True)
+                    pending.append((path, info,
+                                    pool.submit(self._extract_member,
+                                                ziparchive, info, path,
+                                                transforms)))
+                else:
+                    pending.append((path, info,
+                                    self._extract_member(ziparchive, info,
+                                                         path, transforms)))
+                while len(pending) > window:
+                    path, info, result = pending.popleft()
+                    yield path, info, _result(result)
+            while pending:
+                path, info, result = pending.popleft()
+                yield path, info, _result(result)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
 
     def combine(self, force=False):
         """
         Combine zip file
+
+        Unless forced, members whose files are unchanged since they were
+        last indexed (by timestamp, or failing that by size and CRC32) are
+        copied still-compressed from the existing archive and only changed
+        members are deflated again.
         """
-        # We can ignore force here, because zipfile doesn't have strong
-        # support for incremental file updates so we are *always*
-        # re-combining the entire file.
-        logging.info("Combining %s", self.archive)
-        ziparchive = zipfile.ZipFile(self.archive, 'w',
-                                     zipfile.ZIP_DEFLATED)
-        for file in self.manifest:
-            ziparchive.write(file, os.path.relpath(file, self.location))
-            yield (file, _datetime_from_epoch(os.path.getmtime(file)))
-        ziparchive.close()
+        previous = None
+        if not force and os.path.exists(self.archive) \
+        and zipfile.is_zipfile(self.archive):
+            logging.info("Incrementally combining %s", self.archive)
+            previous = zipfile.ZipFile(self.archive)
+        else:
+            logging.info("Combining %s", self.archive)
+
+        # Both counted as the members' uncompressed sizes
+        self.bytes_compressed = 0
+        self.bytes_copied = 0
+        # The archive is written to a temporary file alongside it and only
+        # swapped in once complete, so the old archive stays intact until
+        # then
+        output = self.archive + '.tmp~'
+        outfile = open(output, 'wb')
+        ziparchive = zipfile.ZipFile(outfile, 'w', zipfile.ZIP_DEFLATED)
+        pool = ThreadPoolExecutor(max_workers=self.threads) \
+            if self.threads > 1 else None
+        try:
+            # Members are compressed ahead (up to a window bounded in both
+            # members and bytes) in the pool but always written in manifest
+            # order, so the output is the same regardless of the number of
+            # threads
+            pending = deque()
+            window = self.threads * 4
+            ahead = 0
+            for file in self.manifest:
+                arcname = os.path.relpath(file, self.location)
+                info = None
+                if previous is not None and self.manifest[file] is not None:
+                    info = previous.NameToInfo.get(
+                        arcname.replace(os.sep, '/'))
+                    if info is not None \
+                    and not self._unchanged(file, self.manifest[file], info):
+                        info = None
+                if info is not None:
+                    pending.append((file, info, None))
+                elif pool is not None:
+                    ahead += self._stat(file).size
+                    pending.append((file, None,
+                                    pool.submit(_compress_file, file,
+                                                arcname, self._stat(file),
+                                                *self._compression(arcname))))
+                else:
+                    pending.append((file, None,
+                                    _compress_file(file, arcname,
+                                                   self._stat(file),
+                                                   *self._compression(
+                                                       arcname))))
+                while len(pending) > window or ahead > _WINDOW_BYTES:
+                    if pending[0][1] is None and pool is not None:
+                        ahead -= self._stat(pending[0][0]).size
+                    yield self._write_pending(previous, ziparchive,
+                                              *pending.popleft())
+            while pending:
+                yield self._write_pending(previous, ziparchive,
+                                          *pending.popleft())
+            ziparchive.close()
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            outfile.close()
+        except BaseException:
+            ziparchive.close()
+            outfile.close()
+            if previous is not None:
+                previous.close()
+            os.remove(output)
+            raise
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+        if previous is not None:
+            previous.close()
+        _replace_file(output, self.archive)
+        logging.info("Combined %s: %d bytes recompressed, %d bytes copied "
+                     "(uncompressed)",
+                     self.archive, self.bytes_compressed, self.bytes_copied)
         yield (self.location,
-               _datetime_from_epoch(os.path.getmtime(self.archive)))
+               os.stat(self.archive).st_mtime_ns)
+
+    def _target(self, info):
+        """
+        Find the file path to extract a member to, sanitized as zipfile
+        does
+        """
+        arcname = info.filename.replace('/', os.path.sep)
+        if os.path.altsep:
+            arcname = arcname.replace(os.path.altsep, os.path.sep)
+        arcname = os.path.splitdrive(arcname)[1]
+        invalid = ('', os.path.curdir, os.path.pardir)
+        arcname = os.path.sep.join(x for x in arcname.split(os.path.sep)
+                                   if x not in invalid)
+        return os.path.normpath(os.path.join(self.location, arcname))
+
+    def _transforms(self, path):
+        return [streaming(fmt, path) for regex, fmt in self.formatters
+                if regex.match(path)]
+
+    def _extract_member(self, ziparchive, info, path, transforms):
+        """
+        Extract a member, passing it through the given formatter transforms
+        on the way, and give the file the member's modification time so
+        that it matches the index exactly
+
+        Returns the timestamp and, for formatted members, the size and
+        CRC32 of the content written.
+        """
+        written = None
+        if transforms:
+            logging.debug("Extracting %s through %d formatter(s)", path,
+                          len(transforms))
+            target = self._target(info)
+            targetdir = os.path.dirname(target)
+            if targetdir:
+                os.makedirs(targetdir, exist_ok=True)
+            with ziparchive.open(info) as source, \
+            open(target, 'wb') as dest:
+                chunks = iter(lambda: source.read(_COPY_CHUNK), b'')
+                for transform in transforms:
+                    chunks = transform(chunks)
+                written = chunks_crc32(_written(chunks, dest))
+        elif _ZERO_COPY and info.compress_type == zipfile.ZIP_STORED \
+        and not info.flag_bits & _MASK_ENCRYPTED \
+        and not info.filename.endswith('/'):
+            target = self._extract_stored(ziparchive, info)
+        else:
+            target = ziparchive.extract(info, self.location)
+        timestamp = member_timestamp(info)
+        if not info.filename.endswith('/'):
+            os.utime(target, ns=(timestamp, timestamp))
+        return timestamp, written
+
+    def _extract_stored(self, ziparchive, info):
+        """
+        Extract an uncompressed member by copying its bytes straight from
+        the archive file to the target file, then verify its CRC
+        """
+        target = self._target(info)
+        targetdir = os.path.dirname(target)
+        if targetdir:
+            os.makedirs(targetdir, exist_ok=True)
+        # Formatted members may be read from other threads meanwhile
+        with ziparchive._lock:
+            offset = _data_offset(ziparchive, info)
+        with open(target, 'wb') as dest:
+            _copy_range(ziparchive.fp.fileno(), offset, info.file_size, dest)
+        crc = 0
+        if info.file_size:
+            with open(target, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                crc = zlib.crc32(data)
+        if crc != info.CRC:
+            os.remove(target)
+            raise zipfile.BadZipFile("Bad CRC-32 for file %r"
+                                     % info.filename)
+        return target
+
+    def _unchanged(self, file, entry, info):
+        """
+        Check that a file and its member of the previous archive both
+        still match the file's index entry
+        """
+        size, crc = member_size_crc(entry)
+        if crc is not None and (info.CRC != crc or info.file_size != size):
+            return False
+        stat = self._stat(file)
+        if stat.mtime <= entry.timestamp or S_ISDIR(stat.mode):
+            # Directories have no content to compare
+            return True
+        # Touched since, but the content may well be the same
+        return entry.crc is not None and stat.size == entry.size \
+            and file_crc32(file) == entry.crc
+
+    def _compression(self, arcname):
+        return self.compression.method(arcname.replace(os.sep, '/'))
+
+    def _stat(self, file):
+        stat = self.stats.get(file)
+        return stat if stat is not None else file_stat(file)
+
+    def _write_pending(self, previous, ziparchive, file, info, compressed):
+        if info is not None:
+            logging.debug("Copying unchanged %s", file)
+            _copy_raw(previous, info, ziparchive)
+            self.bytes_copied += info.file_size
+            # The file may still differ from its member, if it is formatted
+            return (file, self._stat(file).mtime) \
+                + tuple(self.manifest[file][1:])
+        zinfo, data, mtime = _result(compressed)
+        if data is None:
+            _write_raw(ziparchive, zinfo, ())
+        else:
+            with data:
+                _write_raw(ziparchive, zinfo,
+                           iter(lambda: data.read(_COPY_CHUNK), b''))
+        self.bytes_compressed += zinfo.file_size
+        return (file, mtime, zinfo.file_size, zinfo.CRC)
 
 HANDLER_CACHE = {'zip': ZipArchiveHandler}
 
@@ -0,0 +1,165 @@
+"""
+Index storage backends for musdex
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+from collections import namedtuple
+import datetime
+import logging
+
+# Bump when the stored representation changes; the index is only a cache
+# so an index of another version is simply discarded
+SQLITE_INDEX_VERSION = 4
+
+# Timestamps are integer nanoseconds since the (UTC) epoch, as in
+# os.stat().st_mtime_ns. The size and CRC32 of a file's content are None
+# when unknown. For files whose content differs from their archive member
+# (as written through post-extract formatters), the member's size and
+# CRC32 are kept as well; otherwise these are None.
+IndexEntry = namedtuple('IndexEntry', 'timestamp size crc member_size '
+                        'member_crc')
+
+def to_timestamp(value):
+    """
+    Convert a datetime to an index timestamp
+
+    Naive datetimes (used by older indexes and handlers) are local time.
+    """
+    if isinstance(value, datetime.datetime):
+        return int(round(value.timestamp() * 1000000)) * 1000
+    return value
+
+def to_entry(value):
+    """
+    Convert a stored or handler-provided index value to an IndexEntry
+
+    Older indexes (and handlers) only provide a timestamp.
+    """
+    if value is None or isinstance(value, IndexEntry):
+        return value
+    if not isinstance(value, (list, tuple)):
+        value = (value,)
+    value = (tuple(value) + (None,) * 4)[:5]
+    return IndexEntry(to_timestamp(value[0]), *value[1:])
+
+def member_size_crc(entry):
+    """
+    Get the (size, CRC32) of the archive member an index entry was
+    extracted from
+    """
+    if entry.member_crc is not None:
+        return entry.member_size, entry.member_crc
+    return entry.size, entry.crc
+
+def stored_entry(entry):
+    """
+    Convert an IndexEntry to the plain list stored in YAML indexes, leaving
+    off the member size and CRC32 when they are the same as the file's
+    """
+    return list(entry) if entry.member_crc is not None else list(entry[:3])
+
+_INSERT = 'INSERT OR REPLACE INTO entries (path, timestamp, size, crc, ' \
+    'member_size, member_crc) VALUES (?, ?, ?, ?, ?, ?)'
+
+class SqliteIndex(MutableMapping):
+    """
+    SqliteIndex is a mapping of filenames to IndexEntry stored in SQLite
+
+    Entries are only read from the database as they are needed, and
+    changes are written as individual rows that are committed by save().
+    """
+
+    def __init__(self, filename):
+        import sqlite3 # Only imported when the SQLite index is in use
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.cache = {}
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SQLITE_INDEX_VERSION:
+            if version:
+                logging.info("Discarding index of another version: %s",
+                             filename)
+            self.db.execute('DROP TABLE IF EXISTS entries')
+            self.db.execute('CREATE TABLE entries (path TEXT PRIMARY KEY, '
+                            'timestamp INTEGER NOT NULL, size INTEGER, '
+                            'crc INTEGER, member_size INTEGER, '
+                            'member_crc INTEGER) WITHOUT ROWID')
+            self.db.execute('PRAGMA user_version = %d'
+                            % SQLITE_INDEX_VERSION)
+            self.db.commit()
+
+    def __getitem__(self, path):
+        if path in self.cache:
+            value = self.cache[path]
+        else:
+            row = self.db.execute('SELECT timestamp, size, crc, member_size, '
+                                  'member_crc FROM entries WHERE path = ?',
+                                  (path,)).fetchone()
+            value = IndexEntry(*row) \
+                if row is not None else None
+            self.cache[path] = value
+        if value is None:
+            raise KeyError(path)
+        return value
+
+    def __contains__(self, path):
+        try:
+            self[path]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, path, entry):
+        entry = to_entry(entry)
+        self.db.execute(_INSERT, (path,) + tuple(entry))
+        self.cache[path] = entry
+
+    def __delitem__(self, path):
+        if path not in self:
+            raise KeyError(path)
+        self.db.execute('DELETE FROM entries WHERE path = ?', (path,))
+        self.cache[path] = None
+
+    def __iter__(self):
+        for row in self.db.execute('SELECT path FROM entries ORDER BY path'):
+            yield row[0]
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def preload(self):
+        """
+        Read every entry at once, for callers that will need most of them
+        """
+        for row in self.db.execute('SELECT path, timestamp, size, crc, '
+                                   'member_size, member_crc FROM entries'):
+            if row[0] not in self.cache:
+                self.cache[row[0]] = IndexEntry(*row[1:])
+
+    def update_all(self, entries):
+        """
+        Bulk insert (filename, entry) pairs
+        """
+        entries = [(path, to_entry(entry)) for path, entry in entries]
+        self.db.executemany(_INSERT, ((path,) + tuple(entry)
+                                      for path, entry in entries))
+        for path, entry in entries:
+            self.cache[path] = entry
+
+    def save(self):
+        """
+        Commit changed entries
+        """
+        self.db.commit()
+
+    def close(self):
+        """
+        Close the underlying database
+        """
+        self.db.close()
+
+# vim: ai et ts=4 sts=4 sw=4
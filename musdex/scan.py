@@ -0,0 +1,90 @@
+"""
+Bulk file system scanning for musdex
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+from collections import namedtuple
+import os
+import os.path
+
+# Modification time as integer nanoseconds, size in bytes and mode, as in
+# os.stat()
+FileStat = namedtuple('FileStat', 'mtime size mode')
+
+def file_stat(filename):
+    """
+    Stat a single file
+    """
+    st = os.stat(filename)
+    return FileStat(st.st_mtime_ns, st.st_size, st.st_mode)
+
+class TreeScan(object):
+    """
+    Lazily walk a directory tree with os.scandir, one directory at a time,
+    keeping the stats of the files found along the way
+
+    Consumers can stop iterating as soon as they have seen enough, and
+    later pick up the walk where it was left.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.stats = {}
+        self._pending = [directory]
+
+    def _scan_next(self):
+        """
+        Scan the next pending directory, returning its files
+        """
+        directory = self._pending.pop()
+        found = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        self._pending.append(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        stat = FileStat(st.st_mtime_ns, st.st_size,
+                                        st.st_mode)
+                        self.stats[entry.path] = stat
+                        found.append((entry.path, stat))
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return found
+
+    def __iter__(self):
+        """
+        Iterate (path, FileStat) pairs for every file in the tree, walking
+        the rest of the tree as needed
+        """
+        for item in list(self.stats.items()):
+            yield item
+        while self._pending:
+            for item in self._scan_next():
+                yield item
+
+    def get(self, filename):
+        """
+        Get the stat of a file, scanning further as needed, or None if it
+        doesn't exist
+        """
+        while filename not in self.stats and self._pending:
+            self._scan_next()
+        if filename in self.stats:
+            return self.stats[filename]
+        # Not under the scanned directory after all
+        try:
+            return file_stat(filename)
+        except FileNotFoundError:
+            return None
+
+    def complete(self):
+        """
+        Walk the rest of the tree and return all of the stats by path
+        """
+        while self._pending:
+            self._scan_next()
+        return self.stats
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -0,0 +1,156 @@
+"""
+Per-phase timing instrumentation for musdex
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+from contextlib import contextmanager
+import functools
+import sys
+import time
+
+STATS = ('calls', 'wall_time', 'cpu_time', 'bytes_read', 'bytes_written')
+
+_recorder = None
+
+def _io_counters():
+    """
+    Bytes read and written by this process so far (from Linux's
+    /proc/self/io), or None where that isn't available
+
+    The bytes read include those of previous reads of /proc/self/io, so
+    the size of this read is returned as well, to be discounted.
+    """
+    try:
+        with open('/proc/self/io', 'rb') as io:
+            data = io.read()
+        counters = dict(line.split(b':', 1)
+                        for line in data.splitlines() if b':' in line)
+        return int(counters[b'rchar']), int(counters[b'wchar']), len(data)
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _add(stats, other):
+    for key in STATS:
+        if other.get(key) is None:
+            continue
+        stats[key] = (stats.get(key) or 0) + other[key]
+
+class Timings(object):
+    """
+    Records wall time, CPU time, bytes read and written and the number of
+    calls of each phase of a run, overall and for each archive
+
+    Phases may nest, so the time of an inner phase is also counted in the
+    phases around it. CPU time and I/O are measured for the whole process,
+    so they include any other threads running at the same time.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.archives = {}
+
+    def _stats(self, name, archive=None):
+        phases = self.phases if archive is None \
+            else self.archives.setdefault(archive, {})
+        return phases.setdefault(name, dict((key, None) for key in STATS))
+
+    @contextmanager
+    def phase(self, name, archive=None):
+        io = _io_counters()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            measured = {
+                'calls': 1,
+                'wall_time': time.perf_counter() - wall,
+                'cpu_time': time.process_time() - cpu,
+            }
+            if io is not None:
+                after = _io_counters()
+                measured['bytes_read'] = after[0] - io[0] - io[2]
+                measured['bytes_written'] = after[1] - io[1]
+            _add(self._stats(name), measured)
+            if archive is not None:
+                _add(self._stats(name, archive), measured)
+
+    def merge(self, report, archive=None):
+        """
+        Merge in the phases of another report (such as from a worker
+        process), attributing them to the given archive
+        """
+        for name, stats in report['phases'].items():
+            _add(self._stats(name), stats)
+            if archive is not None:
+                _add(self._stats(name, archive), stats)
+
+    def report(self):
+        return {'phases': self.phases, 'archives': self.archives}
+
+def enable(recorder):
+    """
+    Record phases to the given Timings (or stop recording, for None),
+    returning the previous recorder
+    """
+    global _recorder
+    previous, _recorder = _recorder, recorder
+    return previous
+
+def current():
+    return _recorder
+
+@contextmanager
+def phase(name, archive=None):
+    """
+    Time a phase, if timings are being recorded
+    """
+    if _recorder is None:
+        yield
+    else:
+        with _recorder.phase(name, archive):
+            yield
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a phase
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def collect(name, func, *args):
+    """
+    Run func with a fresh recorder, timing it as the given phase, and
+    return its result along with the report of its phases
+
+    This is used to time the work done for each archive, which may run in
+    a worker process.
+    """
+    recorder = Timings()
+    previous = enable(recorder)
+    try:
+        with recorder.phase(name):
+            result = func(*args)
+    finally:
+        enable(previous)
+    return result, recorder.report()
+
+def write_report(recorder, filename, command=None):
+    """
+    Write a recorder's report as JSON to the given file (or standard error,
+    for -)
+    """
+    import json
+    report = dict(recorder.report(), command=command)
+    output = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if filename == '-':
+        sys.stderr.write(output)
+    else:
+        with open(filename, 'w') as f:
+            f.write(output)
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -3,44 +3,574 @@ VCS routines for musdex
 """
 # Copyright 2010 Max Battcher. Some rights reserved.
 # Licensed for use under the Ms-RL. See attached LICENSE file.
-from subprocess import check_call, check_output
+from bisect import bisect_left
+import importlib
+import json
 import logging
+import os
+import os.path
+import re
+import struct
+import sys
+
+from . import timings
+
+# subprocess and tempfile are imported where they are needed, as a
+# current manifest cache avoids running the VCS at all
 
 DARCS_ADD = 'darcs add'
 DARCS_REMOVE = 'darcs remove'
 DARCS_SHOW_FILES = 'darcs show files --no-directories'
+DARCS_SHOW_CHANGED = 'darcs whatsnew --summary --look-for-adds'
+
+# A line of darcs' whatsnew summary: status (lowercase a for files found
+# by --look-for-adds), path and added/removed lines
+_DARCS_SUMMARY = re.compile(r'^[MARa]!?\s+(.+?)(?:\s+-\d+\s+\+\d+)?$')
+
+# The manifest cache is kept with the index in musdex's base directory
+DEFAULT_MANIFEST_CACHE = os.path.join("_musdex", ".musdex.manifest")
+
+# Files whose modification marks a change to the set of tracked files,
+# by the directory identifying the VCS
+VCS_STATE_FILES = {
+    '_darcs': ['_darcs/hashed_inventory', '_darcs/patches/pending'],
+    '.git': ['.git/index'],
+    '.hg': ['.hg/dirstate'],
+    '.svn': ['.svn/wc.db'],
+}
+
+# Per-argument bookkeeping cost (argv pointer) when spawning a process
+ARG_OVERHEAD = 8
+
+class Manifest(object):
+    """
+    Manifest is the set of files stored in version control, kept as a
+    sorted list so that the files under a path prefix can be found by
+    binary search
+    """
+
+    def __init__(self, files=()):
+        self.files = sorted(set(files))
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, file):
+        i = bisect_left(self.files, file)
+        return i < len(self.files) and self.files[i] == file
+
+    def _range(self, prefix):
+        lo = bisect_left(self.files, prefix)
+        if not prefix:
+            return lo, len(self.files)
+        # Every path starting with prefix sorts before its "successor"
+        successor = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return lo, bisect_left(self.files, successor, lo)
+
+    def under(self, prefix):
+        """
+        List the files starting with the given path prefix
+        """
+        lo, hi = self._range(prefix)
+        return self.files[lo:hi]
+
+    def add(self, file):
+        """
+        Add a file to the manifest
+        """
+        i = bisect_left(self.files, file)
+        if i == len(self.files) or self.files[i] != file:
+            self.files.insert(i, file)
+
+    def discard(self, file):
+        """
+        Remove a file from the manifest, if present
+        """
+        i = bisect_left(self.files, file)
+        if i < len(self.files) and self.files[i] == file:
+            del self.files[i]
+
+class CommandBackend(object):
+    """
+    Run configurable VCS commands (darcs commands by default)
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.batched = config["vcs_batch"] if "vcs_batch" in config \
+            else True
+
+    def state_files(self):
+        if 'vcs_state_files' in self.config:
+            return self.config['vcs_state_files']
+        for vcsdir, files in sorted(VCS_STATE_FILES.items()):
+            if os.path.isdir(vcsdir):
+                return files
+        return None
+
+    def manifest(self):
+        from subprocess import check_output
+        cmd = _command(self.config, "vcs_show_files", DARCS_SHOW_FILES)
+        output = check_output(cmd, universal_newlines=True)
+
+        # ASSUME: Broken by newlines with no filenames with newlines
+        return Manifest(f for f in output.splitlines() if f)
+
+    def changed_files(self):
+        from subprocess import CalledProcessError, PIPE, Popen, check_output
+        if 'vcs_show_changed' in self.config:
+            cmd = self.config['vcs_show_changed'].split()
+            output = check_output(cmd, universal_newlines=True)
+            return [f for f in output.splitlines() if f]
+
+        proc = Popen(DARCS_SHOW_CHANGED.split(), stdout=PIPE,
+                     universal_newlines=True)
+        output = proc.communicate()[0]
+        # darcs whatsnew exits with status 1 when there are no changes
+        if proc.returncode not in (0, 1):
+            raise CalledProcessError(proc.returncode, DARCS_SHOW_CHANGED)
+        changed = []
+        for line in output.splitlines():
+            match = _DARCS_SUMMARY.match(line.strip())
+            if match:
+                changed.append(os.path.normpath(match.group(1)))
+        return changed
+
+    def _run(self, key, default, files):
+        from subprocess import check_call
+        cmd = _command(self.config, key, default)
+        if not self.batched:
+            for file in files:
+                with timings.phase('vcs.command'):
+                    check_call(cmd + [file])
+            return
+        for chunk in _chunks(cmd, files, _arg_limit()):
+            with timings.phase('vcs.command'):
+                check_call(cmd + chunk)
+
+    def add_files(self, files):
+        self._run("vcs_add", DARCS_ADD, files)
+
+    def remove_files(self, files):
+        self._run("vcs_remove", DARCS_REMOVE, files)
+
+class GitBackend(object):
+    """
+    Work with git directly: the manifest is read from the git index file
+    and files are staged through a single git update-index call
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def state_files(self):
+        gitdir = _find_gitdir(os.getcwd())
+        return [os.path.join(gitdir[0], 'index')] if gitdir else None
+
+    def manifest(self):
+        gitdir = _find_gitdir(os.getcwd())
+        if gitdir is not None:
+            try:
+                return Manifest(_read_git_index(*gitdir))
+            except (OSError, ValueError) as err:
+                logging.debug("Unable to read git index, "
+                              "falling back to git ls-files: %s", err)
+        from subprocess import check_output
+        output = check_output(['git', 'ls-files', '-z'])
+        return Manifest(os.fsdecode(f) for f in output.split(b'\0') if f)
+
+    def changed_files(self):
+        from subprocess import check_output
+        # Paths in git status are relative to the top of the work tree
+        gitdir = _find_gitdir(os.getcwd())
+        worktree = gitdir[1] if gitdir else os.getcwd()
+        output = check_output(['git', 'status', '--porcelain', '-z'])
+        entries = output.split(b'\0')
+        changed = []
+        i = 0
+        while i < len(entries):
+            entry = entries[i]
+            i += 1
+            if len(entry) < 4:
+                continue
+            paths = [entry[3:]]
+            if entry[:1] in (b'R', b'C'):
+                # Renames and copies are followed by their original path
+                paths.append(entries[i])
+                i += 1
+            for path in paths:
+                changed.append(os.path.relpath(
+                    os.path.join(worktree, os.fsdecode(path))))
+        return changed
+
+    def _update_index(self, args, files):
+        from subprocess import CalledProcessError, PIPE, Popen
+        if not files:
+            return
+        stdin = b''.join(os.fsencode(file) + b'\0' for file in files)
+        with timings.phase('vcs.command'):
+            proc = Popen(['git', 'update-index'] + args + ['-z', '--stdin'],
+                         stdin=PIPE)
+            proc.communicate(stdin)
+        if proc.returncode:
+            raise CalledProcessError(proc.returncode, 'git update-index')
+
+    def add_files(self, files):
+        # git tracks files, not directories
+        self._update_index(['--add'],
+                           [file for file in files if not os.path.isdir(file)])
+
+    def remove_files(self, files):
+        self._update_index(['--force-remove'], files)
+
+def _find_gitdir(path):
+    """
+    Find the git directory for a path, as (git directory, work tree)
+    """
+    while True:
+        dotgit = os.path.join(path, '.git')
+        if os.path.isdir(dotgit):
+            return dotgit, path
+        elif os.path.isfile(dotgit):
+            # Linked work trees and submodules point to their git directory
+            with open(dotgit, 'r') as f:
+                line = f.readline().strip()
+            if line.startswith('gitdir:'):
+                return os.path.join(path, line[7:].strip()), path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+_GIT_ENTRY_HEADER = struct.Struct('>10I')
+_GIT_EXTENDED = 0x4000
+_GIT_NAME_MASK = 0x0fff
+_GIT_MODE_DIR = 0o040000
+
+def _git_hash_size(gitdir):
+    try:
+        with open(os.path.join(gitdir, 'config'), 'r') as f:
+            config = f.read().lower()
+    except OSError:
+        return 20
+    return 32 if re.search(r'objectformat\s*=\s*sha256', config) else 20
 
+def _varint(data, pos):
+    # git's offset encoding, as used by index version 4
+    c = data[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+def _read_git_index(gitdir, worktree):
+    """
+    Read the paths tracked in a git index file (versions 2 to 4), relative
+    to the current directory
+
+    Raises ValueError for indexes that can't be read directly (such as
+    split or sparse indexes).
+    """
+    with open(os.path.join(gitdir, 'index'), 'rb') as f:
+        data = f.read()
+    if data[:4] != b'DIRC':
+        raise ValueError("Not a git index file")
+    version, count = struct.unpack('>II', data[4:12])
+    if version not in (2, 3, 4):
+        raise ValueError("Unsupported git index version: %d" % version)
+    hashsize = _git_hash_size(gitdir)
+    header = _GIT_ENTRY_HEADER.size + hashsize
+
+    prefix = os.path.relpath(os.getcwd(), worktree).replace(os.sep, '/')
+    prefix = b'' if prefix == '.' else os.fsencode(prefix) + b'/'
+
+    paths = []
+    pos = 12
+    path = b''
+    for _ in range(count):
+        start = pos
+        fields = _GIT_ENTRY_HEADER.unpack_from(data, pos)
+        if fields[6] & 0o170000 == _GIT_MODE_DIR:
+            raise ValueError("Sparse git index")
+        flags, = struct.unpack_from('>H', data, pos + header)
+        pos += header + 2
+        if version >= 3 and flags & _GIT_EXTENDED:
+            pos += 2
+        if version == 4:
+            strip, pos = _varint(data, pos)
+            end = data.index(b'\0', pos)
+            path = path[:len(path) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b'\0', pos)
+            path = data[pos:end]
+            # Entries are padded with NULs to a multiple of eight bytes
+            pos = start + ((end - start) // 8 + 1) * 8
+        if path.startswith(prefix):
+            paths.append(path[len(prefix):])
+
+    # Extensions follow the entries, up to the trailing checksum
+    while pos + 8 <= len(data) - hashsize:
+        signature = data[pos:pos + 4]
+        size, = struct.unpack_from('>I', data, pos + 4)
+        if signature in (b'link', b'sdir'):
+            raise ValueError("Split or sparse git index")
+        pos += 8 + size
+
+    return (os.fsdecode(path).replace('/', os.sep) for path in paths)
+
+BACKEND_CACHE = {'command': CommandBackend, 'git': GitBackend}
+
+def get_backend(config):
+    """
+    Find the VCS backend given by the vcs key of the configuration
+    """
+    name = config['vcs'] if 'vcs' in config else 'command'
+    if name not in BACKEND_CACHE:
+        logging.debug('Importing VCS backend: %s', name)
+        pieces = name.rsplit('.', 1)
+        _temp = None
+        try:
+            _temp = importlib.import_module(pieces[0])
+        except ImportError:
+            logging.warning('Adding current directory to search path for VCS backend: %s', name)
+            sys.path.append(os.getcwd())
+            _temp = importlib.import_module(pieces[0])
+        BACKEND_CACHE[name] = getattr(_temp, pieces[1])
+    return BACKEND_CACHE[name](config)
+
+@timings.timed('vcs.changed_files')
+def changed_files(config):
+    """
+    List the files with pending (uncommitted) changes in version control
+    """
+    logging.debug("Listing changed files")
+    return get_backend(config).changed_files()
+
+def _manifest_cache(config):
+    if 'manifest_cache' in config:
+        if not config['manifest_cache']:
+            return None
+        elif config['manifest_cache'] is not True:
+            return config['manifest_cache']
+    return DEFAULT_MANIFEST_CACHE
+
+def _vcs_state(config, backend):
+    """
+    Identify the current state of the VCS's list of tracked files by its
+    state files' modification times, or None if it can't be identified
+    """
+    files = backend.state_files()
+    if not files:
+        return None
+    state = {
+        'cwd': os.getcwd(),
+        'config': [config[key] if key in config else None for key in
+                   ('vcs', 'vcs_show_files', 'vcs_state_files')],
+        'files': [],
+    }
+    for filename in files:
+        try:
+            st = os.stat(filename)
+            state['files'].append([filename, st.st_mtime_ns, st.st_size,
+                                   st.st_ino])
+        except OSError:
+            state['files'].append([filename, None])
+    return state
+
+def _load_cached_manifest(cachefile, state):
+    try:
+        with open(cachefile, 'rb') as f:
+            header = f.readline()
+            if json.loads(header.decode('utf-8')) != state:
+                return None
+            data = f.read()
+    except (OSError, ValueError):
+        return None
+    return Manifest(os.fsdecode(f) for f in data.split(b'\0') if f)
+
+def _save_cached_manifest(cachefile, state, manifest):
+    import tempfile
+    try:
+        cachedir = os.path.dirname(cachefile)
+        if cachedir:
+            os.makedirs(cachedir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=cachedir or '.', suffix='.tmp~')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(state).encode('utf-8') + b'\n')
+            f.write(b'\0'.join(os.fsencode(file) for file in manifest))
+        os.replace(tmpname, cachefile)
+    except OSError as err:
+        # The cache is only an optimization
+        logging.debug("Unable to save manifest cache: %s", err)
+
+def cached_manifest(config):
+    """
+    Get the manifest from the manifest cache, if it is still current,
+    without asking the VCS
+    """
+    cachefile = _manifest_cache(config)
+    if cachefile is None:
+        return None
+    state = _vcs_state(config, get_backend(config))
+    if state is None:
+        return None
+    return _load_cached_manifest(cachefile, state)
+
+@timings.timed('vcs.manifest')
 def manifest(config):
     """
     Load the manifest of files stored in version control
+
+    The manifest is cached (by default in _musdex/.musdex.manifest) for as
+    long as the VCS's state files are unchanged.
     """
+    backend = get_backend(config)
+    cachefile = _manifest_cache(config)
+    state = _vcs_state(config, backend) if cachefile is not None else None
+    if state is not None:
+        cached = _load_cached_manifest(cachefile, state)
+        if cached is not None:
+            logging.debug("Using cached manifest")
+            return cached
+
     logging.debug("Loading manifest")
-    cmd = config["vcs_show_files"] if "vcs_show_files" in config \
-        else DARCS_SHOW_FILES
-    cmd = cmd.split(' ')
-    output = check_output(cmd, universal_newlines=True)
+    result = backend.manifest()
+    if state is not None:
+        _save_cached_manifest(cachefile, state, result)
+    return result
 
-    # ASSUME: Broken by newlines with no filenames with newlines
-    return (f for f in output.splitlines() if f)
+def _command(config, key, default):
+    return (config[key] if key in config else default).split()
 
 def add_file(config, file):
     """
     Add a file to version control
     """
     logging.debug("Adding %s", file)
-    cmd = config["vcs_add"] if "vcs_add" in config else DARCS_ADD
-    cmd = cmd.split(' ')
-    cmd.append(file)
-    check_call(cmd)
+    batch = Batch(config)
+    batch.add_file(file)
+    batch.flush()
 
 def remove_file(config, file):
     """
     Remove a file from version control
     """
     logging.debug("Removing %s", file)
-    cmd = config["vcs_remove"] if "vcs_remove" in config else DARCS_REMOVE
-    cmd = cmd.split(' ')
-    cmd.append(file)
-    check_call(cmd)
+    batch = Batch(config)
+    batch.remove_file(file)
+    batch.flush()
+
+def _arg_limit():
+    """
+    Estimate how many bytes of arguments may be passed to a new process
+    """
+    if os.name == 'nt':
+        return 32767 // 2 # CreateProcess limit, in characters
+    try:
+        limit = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        limit = -1
+    if limit <= 0:
+        limit = 4096 # POSIX minimum
+    environ = sum(len(k) + len(v) + 2 + ARG_OVERHEAD
+                  for k, v in os.environ.items())
+    # Leave generous headroom for anything we have not accounted for
+    return max((limit - environ) // 2, 2048)
+
+def _chunks(cmd, files, limit):
+    """
+    Split files into argument lists for cmd that fit within limit bytes
+    """
+    base = sum(len(os.fsencode(arg)) + 1 + ARG_OVERHEAD for arg in cmd)
+    chunk = []
+    size = base
+    for file in files:
+        cost = len(os.fsencode(file)) + 1 + ARG_OVERHEAD
+        if chunk and size + cost > limit:
+            yield chunk
+            chunk = []
+            size = base
+        chunk.append(file)
+        size += cost
+    if chunk:
+        yield chunk
+
+class Batch(object):
+    """
+    Batch collects files to add to or remove from version control and
+    passes them to the VCS backend in as few calls as possible when
+    flushed
+
+    Set vcs_batch to false in the configuration for a VCS command that
+    only accepts a single file per command.
+
+    The given manifest (or else the cached manifest, if it is current) is
+    updated with the flushed files, and the manifest cache saved with it.
+    """
+
+    def __init__(self, config, manifest=None):
+        self.config = config
+        self.manifest = manifest
+        self.pending = []
+
+    def _queue(self, action, file):
+        # Adds and removes are kept in the order they were requested
+        if self.pending and self.pending[-1][0] == action:
+            self.pending[-1][1].append(file)
+        else:
+            self.pending.append((action, [file]))
+
+    def add_file(self, file):
+        """
+        Queue a file to be added to version control
+        """
+        self._queue('add', file)
+
+    def remove_file(self, file):
+        """
+        Queue a file to be removed from version control
+        """
+        self._queue('remove', file)
+
+    def flush(self):
+        """
+        Pass all queued files to version control
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        backend = get_backend(self.config)
+        manifest = self.manifest
+        if manifest is None:
+            manifest = cached_manifest(self.config)
+        for action, files in pending:
+            logging.debug("%s %d file(s)",
+                          "Adding" if action == 'add' else "Removing",
+                          len(files))
+            with timings.phase('vcs.' + action):
+                if action == 'add':
+                    backend.add_files(files)
+                else:
+                    backend.remove_files(files)
+            if manifest is None:
+                continue
+            for file in files:
+                if action == 'remove':
+                    manifest.discard(file)
+                elif not os.path.isdir(file):
+                    manifest.add(file)
+
+        cachefile = _manifest_cache(self.config)
+        state = _vcs_state(self.config, backend) \
+            if cachefile is not None and manifest is not None else None
+        if state is not None:
+            _save_cached_manifest(cachefile, state, manifest)
 
 # vim: ai et ts=4 sts=4 sw=4
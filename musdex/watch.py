@@ -0,0 +1,194 @@
+"""
+File system watchers for musdex watch
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path
+import select
+import struct
+import time
+
+from .scan import TreeScan
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Finished writes and renames are enough: editors either write files in
+# place or save a new file over the old one
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_EVENT = struct.Struct('iIII')
+
+class Overflow(Exception):
+    """
+    Raised when events were lost and anything may have changed
+    """
+
+class InotifyWatcher(object):
+    """
+    Watch files and directory trees with Linux inotify, by way of ctypes
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
+        self.trees = set()
+
+    def _add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                         WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, os.strerror(err), directory)
+        self.watches[wd] = directory
+
+    def _add_tree(self, directory):
+        self.trees.add(directory)
+        self._add_watch(directory)
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for dirname in dirnames:
+                self._add_watch(os.path.join(dirpath, dirname))
+
+    def watch(self, files, trees):
+        """
+        Watch the given files (by way of their directories) and the
+        directory trees
+        """
+        for wd in list(self.watches):
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches = {}
+        self.trees = set()
+        for directory in set(os.path.dirname(f) or os.curdir for f in files):
+            self._add_watch(directory)
+        for tree in trees:
+            self._add_tree(tree)
+
+    def _in_tree(self, path):
+        return any(path == tree or path.startswith(tree + os.sep)
+                   for tree in self.trees)
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds (or forever, for None) for changes,
+        returning the set of changed paths
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                raise Overflow()
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) \
+                if name else directory
+            path = os.path.normpath(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) \
+            and self._in_tree(path):
+                # Watch (and report the files of) new subdirectories
+                self._add_tree(path)
+                changed.update(filename for filename, stat
+                               in TreeScan(path))
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """
+    Watch files and directory trees by comparing their stats every
+    interval seconds
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.files = []
+        self.trees = []
+        self.snapshot = {}
+
+    def _snapshot(self):
+        snapshot = {}
+        for filename in self.files:
+            try:
+                st = os.stat(filename)
+                snapshot[filename] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+        for tree in self.trees:
+            for path, stat in TreeScan(tree):
+                snapshot[path] = (stat.mtime, stat.size)
+        return snapshot
+
+    def watch(self, files, trees):
+        self.files = list(files)
+        self.trees = list(trees)
+        self.snapshot = self._snapshot()
+
+    def read(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = self.interval if deadline is None \
+                else min(self.interval, max(deadline - time.time(), 0))
+            time.sleep(wait)
+            snapshot = self._snapshot()
+            changed = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+def get_watcher(poll=False, interval=1.0):
+    """
+    Get an inotify watcher, or a polling watcher if inotify isn't
+    available (or polling is asked for)
+    """
+    if not poll:
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as err:
+            logging.info("Falling back to polling for changes: %s", err)
+    return PollingWatcher(interval)
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -0,0 +1,363 @@
+"""
+In-process XML pretty-printer for musdex
+
+The output follows ``xmllint --format`` for the common cases: ignorable
+whitespace is dropped, element-only content is indented by two spaces
+per level and mixed content is left as it is.
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import codecs
+import xml.parsers.expat
+
+# libxml2 stops indenting deeper than this
+MAX_INDENT_LEVEL = 30
+
+_BLANKS = ' \t\r\n'
+
+# libxml2's per-element whitespace states
+_SPACE_DEFAULT = -1
+_SPACE_MIXED = -2 # Text starting with blanks was kept; keep all blanks
+_SPACE_XML_DEFAULT = 0 # xml:space="default"
+_SPACE_PRESERVE = 1 # xml:space="preserve"
+
+class _Element(object):
+    __slots__ = ('name', 'attributes', 'children', 'space')
+
+    def __init__(self, name, attributes, space):
+        self.name = name
+        self.attributes = attributes
+        self.children = []
+        self.space = space
+
+class _Text(object):
+    __slots__ = ('data', 'cdata')
+
+    def __init__(self, data, cdata=False):
+        self.data = data
+        self.cdata = cdata
+
+class _Markup(object):
+    """
+    Comments and processing instructions, already serialized
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+# Characters libxml2's fast character data path consumes (besides \n)
+_FAST_CHARS = frozenset(chr(c) for c in range(0x20, 0x80)) \
+    - frozenset('&<]') | frozenset('\t')
+
+_PREDEFINED = {'lt': '<', 'gt': '>', 'amp': '&', 'apos': "'", 'quot': '"'}
+
+def _split_char_data(text, follow):
+    """
+    Split raw character data (without references) into the pieces
+    libxml2's parser reports it in, as (raw piece, following characters,
+    whether it came from the slow path)
+
+    Whether blanks are ignorable is decided per piece, and libxml2 breaks
+    pieces at CRLF line breaks and where it leaves its ASCII fast path.
+    """
+    raw = text + follow
+    n = len(text)
+    pieces = []
+    cur = pos = 0
+    while True:
+        while pos < n and (raw[pos] == ' ' or raw[pos] == '\n'):
+            pos += 1
+        while True:
+            while pos < n and (raw[pos] in _FAST_CHARS or raw[pos] == '\n'):
+                pos += 1
+            if pos < n and raw[pos] == ']':
+                pos += 1
+                continue
+            break
+        if pos > cur:
+            pieces.append((raw[cur:pos], raw[pos:pos + 2], False))
+        cur = pos
+        if pos >= n:
+            return pieces
+        if raw[pos] == '\r' and raw[pos + 1:pos + 2] == '\n':
+            cur = pos + 1
+            pos += 2
+            if pos < n and (raw[pos] in _FAST_CHARS or raw[pos] == '\n'):
+                continue
+        break
+    # The rest is handled by the slower, buffering path in one piece
+    pieces.append((raw[cur:n], follow, True))
+    return pieces
+
+def _normalize_newlines(text):
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+class _TreeBuilder(object):
+    """
+    Build a lightweight tree, keeping qualified names and attribute order
+    as written and dropping whitespace the way libxml2 does when it
+    doesn't keep blanks
+
+    Character data is taken from the raw document (located by expat's
+    byte offsets) so that it can be split into pieces as libxml2 would.
+    """
+
+    def __init__(self):
+        self.declaration = None
+        self.encoding = 'utf-8'
+        self.doctype = None
+        self.top = []
+        self.stack = []
+        self.text_start = None
+        self.in_cdata = False
+
+    def parse(self, data):
+        self.data = data
+        self.parser = xml.parsers.expat.ParserCreate()
+        parser = self.parser
+        parser.ordered_attributes = True
+        parser.XmlDeclHandler = self.xml_decl
+        parser.StartDoctypeDeclHandler = self.start_doctype
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.characters
+        parser.CommentHandler = self.comment
+        parser.ProcessingInstructionHandler = self.processing_instruction
+        parser.StartCdataSectionHandler = self.start_cdata
+        parser.EndCdataSectionHandler = self.end_cdata
+        parser.Parse(data, True)
+
+    def _children(self):
+        return self.stack[-1].children if self.stack else self.top
+
+    def _flush(self):
+        if self.text_start is None:
+            return
+        end = self.parser.CurrentByteIndex
+        text = self.data[self.text_start:end].decode(self.encoding)
+        follow = self.data[end:end + 2].decode('latin-1')
+        self.text_start = None
+        if not self.stack:
+            return
+
+        # Split out references, which are always reported as text
+        pos = 0
+        while pos < len(text):
+            amp = text.find('&', pos)
+            if amp == -1:
+                self._char_data(text[pos:], follow)
+                break
+            if amp > pos:
+                self._char_data(text[pos:amp], text[amp:amp + 2])
+            semi = text.index(';', amp)
+            self._append_text(_resolve(text[amp + 1:semi]))
+            pos = semi + 1
+
+    def _char_data(self, text, follow):
+        element = self.stack[-1]
+        for piece, after, slow in _split_char_data(text, follow):
+            if piece.strip(_BLANKS) or self._keep_blanks(after):
+                self._append_text(_normalize_newlines(piece))
+                if (slow or piece[0] in _BLANKS) \
+                and element.space == _SPACE_DEFAULT:
+                    element.space = _SPACE_MIXED
+
+    def _append_text(self, data):
+        children = self.stack[-1].children
+        if children and isinstance(children[-1], _Text) \
+        and not children[-1].cdata:
+            children[-1].data += data
+        else:
+            children.append(_Text(data))
+
+    def _keep_blanks(self, after):
+        element = self.stack[-1]
+        if element.space in (_SPACE_PRESERVE, _SPACE_MIXED):
+            return True
+        if after[:1] not in ('<', '\r'):
+            return True
+        children = element.children
+        if not children:
+            # Blanks as the only content of an element are kept
+            return after == '</'
+        first, last = children[0], children[-1]
+        return (isinstance(first, _Text) and not first.cdata) \
+            or (isinstance(last, _Text) and not last.cdata)
+
+    def xml_decl(self, version, encoding, standalone):
+        if encoding is not None:
+            if codecs.lookup(encoding).name.startswith('utf-16'):
+                raise ValueError("UTF-16 documents are not supported")
+            self.encoding = encoding
+        self.declaration = (version, encoding, standalone)
+
+    def start_doctype(self, name, system_id, public_id, has_internal_subset):
+        if has_internal_subset:
+            raise ValueError("Internal DTD subsets are not supported")
+        if public_id:
+            self.doctype = '<!DOCTYPE %s PUBLIC "%s" "%s">' \
+                % (name, public_id, system_id)
+        elif system_id:
+            self.doctype = '<!DOCTYPE %s SYSTEM "%s">' % (name, system_id)
+        else:
+            self.doctype = '<!DOCTYPE %s>' % name
+
+    def start_element(self, name, attributes):
+        self._flush()
+        pairs = list(zip(attributes[::2], attributes[1::2]))
+        # libxml2 writes namespace declarations ahead of other attributes
+        pairs = [p for p in pairs if _is_namespace(p[0])] \
+            + [p for p in pairs if not _is_namespace(p[0])]
+        space = self.stack[-1].space if self.stack else _SPACE_DEFAULT
+        if space == _SPACE_MIXED:
+            space = _SPACE_DEFAULT
+        for key, value in pairs:
+            if key == 'xml:space' and value == 'preserve':
+                space = _SPACE_PRESERVE
+            elif key == 'xml:space' and value == 'default':
+                space = _SPACE_XML_DEFAULT
+        element = _Element(name, pairs, space)
+        self._children().append(element)
+        self.stack.append(element)
+
+    def end_element(self, name):
+        self._flush()
+        self.stack.pop()
+
+    def characters(self, data):
+        if self.in_cdata:
+            self._children()[-1].data += data
+        elif self.text_start is None:
+            self.text_start = self.parser.CurrentByteIndex
+
+    def comment(self, data):
+        self._flush()
+        self._children().append(_Markup('<!--%s-->' % data))
+
+    def processing_instruction(self, target, data):
+        self._flush()
+        if data:
+            self._children().append(_Markup('<?%s %s?>' % (target, data)))
+        else:
+            self._children().append(_Markup('<?%s?>' % target))
+
+    def start_cdata(self):
+        self._flush()
+        children = self._children()
+        # Adjacent CDATA sections are merged into one
+        if not children or not isinstance(children[-1], _Text) \
+        or not children[-1].cdata:
+            children.append(_Text('', cdata=True))
+        self.in_cdata = True
+
+    def end_cdata(self):
+        self.in_cdata = False
+
+def _resolve(reference):
+    if reference.startswith('#x'):
+        return chr(int(reference[2:], 16))
+    elif reference.startswith('#'):
+        return chr(int(reference[1:]))
+    elif reference in _PREDEFINED:
+        return _PREDEFINED[reference]
+    raise ValueError("Unsupported entity reference: &%s;" % reference)
+
+def _is_namespace(name):
+    return name == 'xmlns' or name.startswith('xmlns:')
+
+class _Serializer(object):
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.out = []
+
+    def _charref(self, char):
+        # Without a declared encoding libxml2 writes ASCII and hexadecimal
+        # character references
+        if self.encoding is None and ord(char) > 0x7f:
+            return '&#x%X;' % ord(char)
+        return char
+
+    def text(self, data):
+        data = data.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('>', '&gt;')
+        data = data.replace('\r', '&#13;' if self.encoding else '&#xD;')
+        if self.encoding is None:
+            data = ''.join(self._charref(c) for c in data)
+        return data
+
+    def attribute(self, data):
+        data = data.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('>', '&gt;').replace('"', '&quot;') \
+            .replace('\n', '&#10;').replace('\r', '&#13;') \
+            .replace('\t', '&#9;')
+        if self.encoding is None:
+            data = ''.join(self._charref(c) for c in data)
+        return data
+
+    def node(self, node, level, formatted):
+        out = self.out
+        if isinstance(node, _Markup):
+            out.append(node.data)
+        elif isinstance(node, _Text):
+            if node.cdata:
+                out.append('<![CDATA[%s]]>' % node.data)
+            else:
+                out.append(self.text(node.data))
+        else:
+            out.append('<' + node.name)
+            for key, value in node.attributes:
+                out.append(' %s="%s"' % (key, self.attribute(value)))
+            if not node.children:
+                out.append('/>')
+                return
+            out.append('>')
+            # Any text content turns formatting off for the whole subtree
+            formatted = formatted and not any(isinstance(child, _Text)
+                                              for child in node.children)
+            if formatted:
+                out.append('\n')
+            for child in node.children:
+                if formatted:
+                    out.append(_indent(level + 1))
+                self.node(child, level + 1, formatted)
+                if formatted:
+                    out.append('\n')
+            if formatted:
+                out.append(_indent(level))
+            out.append('</%s>' % node.name)
+
+def _indent(level):
+    return '  ' * min(level, MAX_INDENT_LEVEL)
+
+def format_xml(data):
+    """
+    Pretty-print an XML document (as bytes), returning bytes
+
+    Raises ValueError (or an expat error) for documents it cannot
+    faithfully reproduce.
+    """
+    builder = _TreeBuilder()
+    builder.parse(data)
+
+    version, encoding, standalone = builder.declaration \
+        or ('1.0', None, -1)
+    serializer = _Serializer(encoding)
+    declaration = '<?xml version="%s"' % version
+    if encoding is not None:
+        declaration += ' encoding="%s"' % encoding
+    if standalone != -1:
+        declaration += ' standalone="%s"' % ('yes' if standalone else 'no')
+    serializer.out.append(declaration + '?>\n')
+    if builder.doctype is not None:
+        serializer.out.append(builder.doctype + '\n')
+    for node in builder.top:
+        serializer.node(node, 0, True)
+        serializer.out.append('\n')
+
+    output = ''.join(serializer.out)
+    if encoding is None:
+        return output.encode('ascii')
+    return output.encode(encoding, 'xmlcharrefreplace')
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -0,0 +1,75 @@
+"""
+Combination checks for the zip handler
+
+Members are compressed ahead in a thread pool but written in manifest
+order, so the combined archive should be the same for any number of
+threads.
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import hashlib
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from musdex import handlers
+from musdex.handlers import ZipArchiveHandler
+
+class CombineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='musdex-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.location = os.path.join(self.directory, 'a.zip')
+        rng = random.Random(1)
+        self.manifest = {}
+        for i in range(40):
+            name = os.path.join(self.location, 'dir%d' % (i % 4),
+                                'member%02d.txt' % i)
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            # A mix of compressible text, random bytes and empty files
+            size = rng.choice([0, 100, 5000, 200000])
+            data = b'musdex archive member\n' * (size // 22) \
+                if i % 2 else rng.getrandbits(size * 8).to_bytes(size,
+                                                                 'little')
+            with open(name, 'wb') as f:
+                f.write(data)
+            self.manifest[name] = None
+        for name in sorted(self.manifest):
+            os.utime(name, ns=(1500000000 * 10 ** 9,) * 2)
+
+    def combine(self, threads, **options):
+        archive = os.path.join(self.directory, 'out%d.zip' % threads)
+        handler = ZipArchiveHandler(archive, self.location, self.manifest,
+                                    threads=threads, **options)
+        list(handler.combine(force=True))
+        with open(archive, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def test_threads(self):
+        digests = set(self.combine(threads) for threads in (1, 2, 8))
+        self.assertEqual(len(digests), 1)
+
+    def test_threads_small_window(self):
+        # Writing pending members early (as for large members) keeps the
+        # order as well
+        window = handlers._WINDOW_BYTES
+        handlers._WINDOW_BYTES = 100000
+        try:
+            digests = set(self.combine(threads, compression='auto')
+                          for threads in (1, 2, 8))
+        finally:
+            handlers._WINDOW_BYTES = window
+        self.assertEqual(len(digests), 1)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -0,0 +1,86 @@
+"""
+Checks that musdex's git index reader agrees with git ls-files
+
+The reader is compared with git ls-files -z for index versions 2, 3 (with
+extended flags, from an intent-to-add entry) and 4, from the top of the
+work tree and from a subdirectory.
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from musdex.vcs import _find_gitdir, _read_git_index
+
+FILES = ['README', 'docs/a.txt', 'docs/b.txt', 'docs/deeper/c.txt',
+         'line\nbreak.txt', 'sp ace.txt', 'unicodé.txt',
+         '_musdex/a.zip/word/document.xml']
+
+def _git(*args):
+    return subprocess.check_output(['git'] + list(args),
+                                   stderr=subprocess.DEVNULL)
+
+@unittest.skipUnless(shutil.which('git'), "git is not installed")
+class GitIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        self.directory = os.path.realpath(
+            tempfile.mkdtemp(prefix='musdex-test-'))
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.chdir(self.directory)
+        _git('init', '-q')
+        for name in FILES:
+            if os.path.dirname(name):
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, 'w') as f:
+                f.write(name)
+        _git('add', '--', *FILES)
+
+    def check(self, version, intent=False):
+        if intent:
+            # Intent-to-add entries have extended flags, which need
+            # version 3 or up
+            with open('intent.txt', 'w') as f:
+                f.write('intent')
+            _git('add', '-N', 'intent.txt')
+        _git('update-index', '--index-version', str(version))
+        with open(os.path.join('.git', 'index'), 'rb') as f:
+            self.assertEqual(f.read(8)[4:], version.to_bytes(4, 'big'))
+        found = {}
+        for subdir in ('', 'docs'):
+            with self.subTest(subdir=subdir):
+                os.chdir(os.path.join(self.directory, subdir))
+                expected = [os.fsdecode(path).replace('/', os.sep)
+                            for path in _git('ls-files', '-z').split(b'\0')
+                            if path]
+                found[subdir] = list(_read_git_index(
+                    *_find_gitdir(os.getcwd())))
+                self.assertEqual(found[subdir], expected)
+        self.assertIn('line\nbreak.txt', found[''])
+
+    def test_version_2(self):
+        self.check(2)
+
+    def test_version_3(self):
+        self.check(3, intent=True)
+
+    def test_version_4(self):
+        self.check(4)
+
+    def test_version_4_extended(self):
+        self.check(4, intent=True)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: ai et ts=4 sts=4 sw=4
@@ -0,0 +1,83 @@
+"""
+Startup checks for musdex status
+
+musdex status is meant to be run from VCS hooks and shell prompts, so it
+should neither import the modules only needed to extract or combine
+archives nor take long to import. Run with:
+
+    python -m pytest tests
+
+The import time limit (in seconds) can be raised for slow machines with
+the MUSDEX_MAX_IMPORT environment variable.
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from benchmark import CONFIG, FAKEVCS, _environ, startup_imports
+
+# musdex.commands (with PyYAML, argparse and logging) imports in about
+# 50 ms, and each of the excluded modules adds 2 to 7 ms, so this only
+# leaves room for a few of those
+MAX_IMPORT = float(os.environ.get('MUSDEX_MAX_IMPORT', '0.07'))
+
+def _import_time(env, module):
+    """
+    Import a module in a new process and return the cumulative time it
+    took, as reported by -X importtime
+    """
+    output = subprocess.check_output([sys.executable, '-X', 'importtime',
+                                      '-c', 'import %s' % module], env=env,
+                                     stderr=subprocess.STDOUT,
+                                     universal_newlines=True)
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 10 ** 6
+    raise AssertionError("No import time for %s" % module)
+
+class StartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='musdex-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        with zipfile.ZipFile(os.path.join(self.directory, 'a.zip'),
+                             'w') as archive:
+            archive.writestr('doc.xml', '<doc>musdex</doc>\n')
+            archive.writestr('dir/part.txt', 'musdex\n')
+        os.mkdir(os.path.dirname(os.path.join(self.directory, CONFIG)))
+        vcs = '%s %s' % (sys.executable, FAKEVCS)
+        with open(os.path.join(self.directory, CONFIG), 'w') as config:
+            config.write('vcs_show_files: %s ls\n' % vcs)
+            config.write('vcs_add: %s add\n' % vcs)
+            config.write('vcs_remove: %s rm\n' % vcs)
+        subprocess.check_call([sys.executable, '-m', 'musdex', '-q', 'add',
+                               'a.zip'], cwd=self.directory, env=_environ())
+
+    def test_status_imports(self):
+        self.assertEqual(startup_imports(self.directory, None), [])
+
+    def test_import_time(self):
+        env = _environ()
+        # Measure with fresh bytecode, rather than whatever is (or isn't)
+        # cached in the tree
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        env['PYTHONPYCACHEPREFIX'] = os.path.join(self.directory, 'pycache')
+        # Best of a few runs, to discount compiling and a busy machine
+        best = min(_import_time(env, 'musdex.commands') for _ in range(5))
+        self.assertLess(best, MAX_IMPORT)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: ai et ts=4 sts=4 sw=4
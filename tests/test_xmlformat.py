@@ -0,0 +1,52 @@
+"""
+Checks that xmlformat pretty-prints as xmllint --format does
+
+Each tests/fixtures/xmlformat/<name>.xml is formatted and compared with
+<name>.formatted.xml, the output of xmllint --format for it. Where
+xmllint is installed, it is checked against that as well.
+"""
+# Copyright 2010 Max Battcher. Some rights reserved.
+# Licensed for use under the Ms-RL. See attached LICENSE file.
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from musdex.xmlformat import format_xml
+
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures', 'xmlformat')
+
+def _fixtures():
+    for name in sorted(os.listdir(FIXTURES)):
+        if name.endswith('.xml') and not name.endswith('.formatted.xml'):
+            yield os.path.join(FIXTURES, name)
+
+def _read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+class XmlFormatTest(unittest.TestCase):
+
+    def test_fixtures(self):
+        for filename in _fixtures():
+            with self.subTest(fixture=os.path.basename(filename)):
+                expected = _read(filename[:-4] + '.formatted.xml')
+                self.assertEqual(format_xml(_read(filename)), expected)
+
+    @unittest.skipUnless(shutil.which('xmllint'), "xmllint is not installed")
+    def test_xmllint(self):
+        for filename in _fixtures():
+            with self.subTest(fixture=os.path.basename(filename)):
+                expected = subprocess.check_output(['xmllint', '--format',
+                                                    filename])
+                self.assertEqual(format_xml(_read(filename)), expected)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: ai et ts=4 sts=4 sw=4